@@ -0,0 +1,354 @@
+'''
+Benchmarks for the slow parts of the sorter. Run from the repo root
+(it needs config.ini, like the rest of the app):
+
+    python benchmark.py read_courses --rows 10000
+    python benchmark.py parse_filenames --count 100000
+    python benchmark.py suite --sections 10000 --files 20000 --output bench.json --compare previous.json
+
+The suite times every step of a nightly run on a registrar-scale schedule 
+and watch folder and saves the results as JSON, so runs on two commits 
+can be compared.
+'''
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import tempfile
+from datetime import timedelta
+from time import perf_counter
+import pandas as pd
+from data_types import *
+from course_index import CourseIndex
+from file_reaper import reap_files
+from format_parser import format_recording_filename
+from video_sorter import RECORDING_START_TOLERANCE, find_course_by_number_and_section, find_course_by_room_and_datetime, get_new_filepath, match_courses_to_recordings, move_unmatched_video, move_video, parse_courses, parse_recording_file, read_courses
+
+SCHEDULE_COLUMNS = ['Course', 'Section #', 'Course Title', 'Meeting Pattern', 'Meetings', 'Instructor LAST', 'Room (cleaned)', 'Instructor', 'Room']
+MEETING_DAYS = ['M', 'T', 'W', 'Th', 'F', 'MW', 'TTh', 'MWF', 'Sa']
+START_TIMES = ['8am', '9:10am', '10:45am', '12pm', '1:30pm', '2:30pm', '4pm', '6:15pm']
+LAST_NAMES = ['BEEKHUIZEN', 'FERGUSON', 'FINCH', 'MORALES', 'NGUYEN', 'OKAFOR', 'SMITH', 'TANAKA']
+FIRST_NAMES = ['MARK', 'IAN', 'LANCE', 'MATTHEW', 'ANH', 'ADA', 'JO', 'KEN']
+
+def generate_schedule(rows: int, seed: int = 0) -> pd.DataFrame:
+    '''
+    Builds a registrar-style schedule export with the given number of sections
+    '''
+    rng = random.Random(seed)
+    records = []
+    for i in range(rows):
+        room = rng.randint(1000, 9999)
+        pattern = f'{rng.choice(MEETING_DAYS)} {rng.choice(START_TIMES)}-{rng.choice(START_TIMES)}'
+        instructor_count = 2 if rng.random() < 0.1 else 1
+        people = [(rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES), f'{rng.randint(0, 99999999):08d}') for _ in range(instructor_count)]
+        records.append({
+            'Course': f'LAW {1000 + i // 4}',
+            'Section #': i % 4 + 1,
+            'Course Title': f'Course {i}',
+            'Meeting Pattern': pattern,
+            'Meetings': pattern,
+            'Instructor LAST': ' & '.join(last for last, _, _ in people),
+            'Room (cleaned)': room,
+            'Instructor': '; '.join(f'{last}, {first} ({unid})' for last, first, unid in people),
+            'Room': f'00700{room}0 - LAW {room}',
+        })
+    return pd.DataFrame(records, columns=SCHEDULE_COLUMNS)
+
+def write_schedule(rows: int, folder: str, seed: int = 0) -> str:
+    '''
+    Writes a synthetic schedule to an excel file in the folder and returns its path
+    '''
+    path = os.path.join(folder, f'schedule_{rows}.xlsx')
+    generate_schedule(rows, seed).to_excel(path, index=False)
+    return path
+
+def read_courses_iterrows(df: pd.DataFrame) -> list[Course]:
+    '''
+    The original row-by-row schedule import, kept as a baseline to compare against
+    '''
+    courses: list[Course] = []
+    df = df.dropna(how='all')
+    for index, row in df.iterrows():
+        instructor = str(row['Instructor LAST']).replace(' & ', ' ') if pd.notna(row['Instructor LAST']) else ''
+        days_pattern = re.findall(r'M|TTh|T|W|F|Sa', str(row['Meeting Pattern']))
+        days = set()
+        for day_pattern in days_pattern:
+            if day_pattern == 'M':
+                days.add('Monday')
+            elif day_pattern == 'TTh':
+                days.add('Tuesday')
+                days.add('Thursday')
+            elif day_pattern == 'T':
+                days.add('Tuesday')
+            elif day_pattern == 'W':
+                days.add('Wednesday')
+            elif day_pattern == 'F':
+                days.add('Friday')
+            elif day_pattern == 'Sa':
+                days.add('Saturday')
+
+        start_time = None
+        start_time_str = re.search(r'\b\d{1,2}:\d{2}(?:am|pm)\b|\b\d{1,2}(?:am|pm)\b', str(row['Meeting Pattern']), re.IGNORECASE)
+        if start_time_str:
+            start_time_str = start_time_str.group().replace('am', 'AM').replace('pm', 'PM')
+            start_time = datetime.strptime(start_time_str, '%I:%M%p' if ':' in start_time_str else '%I%p').time()
+
+        instructors = []
+        for s in row['Instructor'].split('; '):
+            groups = re.search(r'([^(),\d]+),\s*([^()\d]+)\s+\((\d{8})\);*\s*', s).groups()
+            instructors.append(EventHost(groups[1], groups[0], groups[2]))
+
+        section_number = row['Section #'] if pd.notna(row['Section #']) else None
+        courses.append(Course(row['Course'], str(section_number), row['Course Title'], instructor, str(row['Room (cleaned)']), days, start_time, instructors))
+
+    return courses
+
+def generate_recordings(count: int, seed: int = 0) -> list[LectureRecording]:
+    '''
+    Builds recordings spread evenly over the three device formats
+    '''
+    rng = random.Random(seed)
+    recs = []
+    for i in range(count):
+        rec_date = date(2023, 1, 1) + timedelta(days=rng.randint(0, 364))
+        rec_time = time(rng.randint(7, 20), rng.randint(0, 59), rng.randint(0, 59))
+        device = i % 3
+        if device == 0:
+            recs.append(LectureRecording(None, rec_date, rec_time, str(rng.randint(1000, 9999)), 'extron'))
+        elif device == 1:
+            recs.append(LectureRecording(None, rec_date, rec_time, '2100', 'extron_2100'))
+        else:
+            recs.append(LectureRecording(None, rec_date, None, None, 'capturecast', str(rng.randint(1000, 9999)), str(rng.randint(1, 4)), 'LAW'))
+    return recs
+
+def generate_filenames(count: int, seed: int = 0) -> list[str]:
+    return [format_recording_filename(rec) for rec in generate_recordings(count, seed)]
+
+def parse_recording_file_chain(filepath: str) -> LectureRecording:
+    '''
+    The original parser chain: each format tried in turn with an 
+    uncompiled pattern and strptime, kept as a baseline to compare against
+    '''
+    filename = os.path.basename(filepath)
+    match = re.match(r'(\d+)_.*?_(\d{8})-(\d{6})_[sS]1[rR]1.mp4', filename)
+    if match:
+        room_number, rec_date, rec_time = match.groups()
+        dt = datetime.strptime(f'{rec_date}{rec_time}', '%Y%m%d%H%M%S')
+        return LectureRecording(filepath, dt.date(), dt.time(), room_number, 'extron')
+    match = re.match(r'(\w+)-(\d+)-(\d+)---(\d{1,2})-(\d{1,2})-(\d{4}).mp4', filename)
+    if match:
+        course_code, course_number, section_number, month, day, year = match.groups()
+        return LectureRecording(filepath, date(int(year), int(month), int(day)), None, None, 'capturecast', course_number, section_number, course_code)
+    match = re.match(r'SMP-2100_(\d{8})-(\d{6})_[sS]1[rR]1.mp4', filename)
+    if match:
+        rec_date, rec_time = match.groups()
+        dt = datetime.strptime(f'{rec_date}{rec_time}', '%Y%m%d%H%M%S')
+        return LectureRecording(filepath, dt.date(), dt.time(), '2100', 'extron_2100')
+    return LectureRecording(filepath, None, None, None, None)
+
+def timed(fn, *args, **kwargs):
+    '''
+    Calls fn and returns its result along with the elapsed seconds. Like 
+    timeit, garbage collection is paused so earlier results don't skew it.
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        start = perf_counter()
+        result = fn(*args, **kwargs)
+        return result, perf_counter() - start
+    finally:
+        gc.enable()
+
+def bench_read_courses(rows: int):
+    with tempfile.TemporaryDirectory() as folder:
+        path = write_schedule(rows, folder)
+        df, excel_seconds = timed(pd.read_excel, path)
+        _, baseline_seconds = timed(read_courses_iterrows, df)
+        _, parse_seconds = timed(parse_courses, df)
+
+    print(f'read_courses over {rows} rows')
+    print(f'  pd.read_excel:      {excel_seconds:8.3f}s')
+    print(f'  row-by-row parse:   {baseline_seconds:8.3f}s')
+    print(f'  column-wise parse:  {parse_seconds:8.3f}s ({baseline_seconds / parse_seconds:.1f}x)')
+
+def bench_parse_filenames(count: int):
+    filenames = generate_filenames(count)
+    for f in filenames[:1000]:
+        assert str(parse_recording_file(f)) == str(parse_recording_file_chain(f))
+
+    def parse_all(parse):
+        for f in filenames:
+            parse(f)
+
+    _, baseline_seconds = timed(parse_all, parse_recording_file_chain)
+    _, parse_seconds = timed(parse_all, parse_recording_file)
+
+    print(f'parse_recording_file over {count} filenames')
+    print(f'  parser chain:       {baseline_seconds:8.3f}s')
+    print(f'  compiled dispatch:  {parse_seconds:8.3f}s ({baseline_seconds / parse_seconds:.1f}x)')
+
+def generate_backlog(courses: list[Course], count: int, seed: int = 0, matched: float = 0.8) -> list[LectureRecording]:
+    '''
+    Builds a watch folder's worth of recordings with distinct filenames, 
+    spread over the three device formats. About `matched` of them are of 
+    a scheduled class during the Fall 2023 semester; the rest are random 
+    and mostly match nothing.
+    '''
+    rng = random.Random(seed)
+    timed_courses = [course for course in courses if course.days and course.start_time is not None]
+    unmatched = iter(generate_recordings(count * 2, seed))
+    names = set()
+    recs = []
+    while len(recs) < count:
+        if rng.random() >= matched:
+            rec = next(unmatched)
+        elif len(recs) % 3 == 2:
+            course = rng.choice(courses)
+            code, _, number = course.number.partition(' ')
+            rec_date = date(2023, 8, 21) + timedelta(days=rng.randint(0, 111))
+            rec = LectureRecording(None, rec_date, None, None, 'capturecast', number, course.section_number, code)
+        else:
+            course = rng.choice(timed_courses)
+            rec_date = date(2023, 8, 21) + timedelta(days=rng.randint(0, 111))
+            if rec_date.strftime('%A') not in course.days:
+                continue
+            rec_time = (datetime.combine(rec_date, course.start_time) + timedelta(minutes=rng.randint(-5, 5))).time()
+            rec = LectureRecording(None, rec_date, rec_time, course.room_number, 'extron')
+        name = format_recording_filename(rec)
+        if name not in names:
+            names.add(name)
+            recs.append(rec)
+    return recs
+
+def write_watch_folder(recs: list[LectureRecording], folder: str):
+    '''
+    Creates an empty file for each recording, named and dated the way its 
+    device would have, like the tests' generate_files
+    '''
+    os.makedirs(folder, exist_ok=True)
+    for rec in recs:
+        rec.filepath = os.path.join(folder, format_recording_filename(rec))
+        open(rec.filepath, 'wb').close()
+        recorded = datetime.combine(rec.date, rec.time or time())
+        os.utime(rec.filepath, (recorded.timestamp(), recorded.timestamp()))
+
+def move_files(pairs: list[tuple[LectureRecording, Course | None]], destination: str):
+    '''
+    Moves recordings that were already matched the way the pipeline's 
+    move stage does, so the moves can be timed without parsing or matching
+    '''
+    folder_cache: dict[tuple[str, str, str], str] = {}
+    for rec, course in pairs:
+        if course is None:
+            move_unmatched_video(rec, destination)
+        else:
+            move_video(rec, get_new_filepath(rec, course, destination, folder_cache=folder_cache))
+
+def stage_result(seconds: float, items: int, **counts) -> dict:
+    return {'seconds': seconds, 'items': items, 'per_second': items / max(seconds, 1e-9), **counts}
+
+def bench_suite(sections: int, files: int, seed: int = 0) -> dict:
+    '''
+    Times each step of sorting files recordings against a schedule of 
+    the given number of sections, separately, and returns the results.
+    Logging is off while it runs, so writing to the terminal isn't timed.
+    '''
+    stages = {}
+    logging.disable(logging.WARNING)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            path = write_schedule(sections, folder, seed)
+            courses, seconds = timed(read_courses, path, use_cache=False)
+            stages['read_courses'] = stage_result(seconds, len(courses))
+            index, seconds = timed(CourseIndex, courses, RECORDING_START_TOLERANCE)
+            stages['build_course_index'] = stage_result(seconds, len(courses))
+
+            watch = os.path.join(folder, 'watch')
+            destination = os.path.join(folder, 'destination')
+            recs = generate_backlog(courses, files, seed)
+            write_watch_folder(recs, watch)
+            paths = [rec.filepath for rec in recs]
+
+            parsed, seconds = timed(lambda: [parse_recording_file(path) for path in paths])
+            stages['parse_recording_file'] = stage_result(seconds, len(parsed))
+
+            timed_recs = [rec for rec in parsed if rec.time is not None]
+            found, seconds = timed(lambda: [find_course_by_room_and_datetime(index, rec) for rec in timed_recs])
+            stages['find_course_by_room_and_datetime'] = stage_result(seconds, len(timed_recs), matched=sum(course is not None for course in found))
+
+            untimed_recs = [rec for rec in parsed if rec.time is None]
+            found, seconds = timed(lambda: [find_course_by_number_and_section(index, rec) for rec in untimed_recs])
+            stages['find_course_by_number_and_section'] = stage_result(seconds, len(untimed_recs), matched=sum(course is not None for course in found))
+
+            pairs, seconds = timed(match_courses_to_recordings, index, watch)
+            stages['match_courses_to_recordings'] = stage_result(seconds, len(pairs), matched=sum(course is not None for _, course in pairs))
+
+            _, seconds = timed(move_files, pairs, destination)
+            stages['move_files'] = stage_result(seconds, len(pairs))
+
+            # Partway through Fall 2023, so the recordings from before then are deleted
+            deleted, seconds = timed(reap_files, destination, datetime(2023, 10, 15))
+            stages['reap_files'] = stage_result(seconds, files, deleted=len(deleted))
+    finally:
+        logging.disable(logging.NOTSET)
+
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {'sections': sections, 'files': files, 'seed': seed},
+        'stages': stages,
+    }
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_suite(results: dict, previous: dict | None = None):
+    parameters = results['parameters']
+    print(f'Benchmark suite over {parameters["sections"]} sections and {parameters["files"]} files at {results["commit"] or "an unknown commit"}')
+    for name, stage in results['stages'].items():
+        counts = ''.join(f', {key} {value}' for key, value in stage.items() if key not in ('seconds', 'items', 'per_second'))
+        line = f'  {name + ":":36}{stage["seconds"]:8.3f}s {stage["per_second"]:12.0f}/s ({stage["items"]} items{counts})'
+        if previous is not None and name in previous['stages']:
+            line += f', {stage["seconds"] / max(previous["stages"][name]["seconds"], 1e-9):.2f}x of {previous["commit"] or "previous"}'
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the video sorter')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    read_parser = subparsers.add_parser('read_courses', help='Time the schedule import')
+    read_parser.add_argument('--rows', type=int, default=10000)
+    parse_parser = subparsers.add_parser('parse_filenames', help='Time recording filename parsing')
+    parse_parser.add_argument('--count', type=int, default=100000)
+    suite_parser = subparsers.add_parser('suite', help='Time every step of a run and save the results as JSON')
+    suite_parser.add_argument('--sections', type=int, default=10000)
+    suite_parser.add_argument('--files', type=int, default=10000)
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--output', help='Save the results to this JSON file')
+    suite_parser.add_argument('--compare', help='Show each step relative to an earlier JSON result')
+    args = parser.parse_args()
+
+    if args.benchmark == 'read_courses':
+        bench_read_courses(args.rows)
+    elif args.benchmark == 'parse_filenames':
+        bench_parse_filenames(args.count)
+    elif args.benchmark == 'suite':
+        previous = None
+        if args.compare:
+            with open(args.compare) as f:
+                previous = json.load(f)
+        results = bench_suite(args.sections, args.files, args.seed)
+        print_suite(results, previous)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
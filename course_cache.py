@@ -0,0 +1,87 @@
+'''
+An on-disk cache of the parsed course list, stored next to the schedule
+workbook. Parsing the workbook with pandas/openpyxl is by far the slowest
+part of starting up, so as long as the workbook hasn't changed the parsed
+courses are loaded from the cache instead.
+'''
+
+from data_types import *
+import hashlib
+import logging
+import os
+import pickle
+
+# Bump this whenever Course or EventHost change shape so old caches are ignored
+CACHE_VERSION = 1
+
+class WorkbookFingerprint:
+    '''
+    Identifies one version of a workbook by its size, modification time
+    and a hash of its contents
+    '''
+    def __init__(self, size: int, mtime_ns: int, sha256: str):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+    def same_contents(self, other) -> bool:
+        return other is not None and self.size == other.size and self.sha256 == other.sha256
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, WorkbookFingerprint) and self.same_contents(other) and self.mtime_ns == other.mtime_ns
+
+    def __str__(self) -> str:
+        return f'WorkbookFingerprint(size={self.size}, mtime_ns={self.mtime_ns}, sha256={self.sha256[:12]})'
+
+def read_workbook(excel_path) -> tuple[bytes, WorkbookFingerprint]:
+    '''
+    Reads the raw bytes of a workbook and fingerprints them. The bytes can be
+    handed straight to pandas so a slow share is only read once.
+    '''
+    with open(excel_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    return data, WorkbookFingerprint(stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).hexdigest())
+
+def get_cache_path(excel_path) -> str:
+    return f'{excel_path}.courses.pkl'
+
+def load_cached_courses(excel_path, fingerprint: WorkbookFingerprint) -> list[Course] | None:
+    '''
+    Returns the cached courses for the workbook if the cache was written for
+    the same contents, otherwise None
+    '''
+    cache_path = get_cache_path(excel_path)
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception as e:
+        logging.warning(f'Ignoring unreadable course cache {cache_path}: {e}')
+        return None
+
+    if cached.get('version') != CACHE_VERSION or not fingerprint.same_contents(cached.get('fingerprint')):
+        logging.info(f'Course cache {cache_path} is out of date')
+        return None
+
+    # Same contents under a new mtime (e.g. the file was re-synced), so refresh the stored key
+    if cached['fingerprint'] != fingerprint:
+        save_cached_courses(excel_path, fingerprint, cached['courses'])
+
+    return cached['courses']
+
+def save_cached_courses(excel_path, fingerprint: WorkbookFingerprint, courses: list[Course]):
+    '''
+    Writes the courses to the cache next to the workbook. Failing to write
+    the cache is not fatal, it just means the next start parses the workbook again.
+    '''
+    cache_path = get_cache_path(excel_path)
+    tmp_path = f'{cache_path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'fingerprint': fingerprint, 'courses': courses}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logging.warning(f'Could not write course cache {cache_path}: {e}')
@@ -0,0 +1,95 @@
+'''
+Prebuilt lookup structures over a list of courses, so that matching a
+recording to a course doesn't need to walk the whole schedule every time.
+'''
+
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+import logging
+from data_types import *
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+class CourseIndex:
+    '''
+    Indexes courses by (room, weekday) and by (course number, section).
+
+    Each (room, weekday) bucket holds the start times of the courses meeting 
+    in that room on that day as sorted minute-of-day offsets, alongside each 
+    course's position in the original list so that lookups return the same 
+    course a first-match scan of the list would.
+    '''
+    def __init__(self, courses: list[Course], tolerance: timedelta):
+        self.courses = courses
+        self.tolerance_minutes = tolerance.total_seconds() / 60
+
+        buckets: dict[tuple[str, str], list[tuple[int, int]]] = {}
+        for position, course in enumerate(courses):
+            if course.start_time is None:
+                continue
+            minutes = course.start_time.hour * 60 + course.start_time.minute
+            for day in course.days:
+                buckets.setdefault((course.room_number, day), []).append((minutes, position))
+
+        self._start_minutes: dict[tuple[str, str], list[int]] = {}
+        self._positions: dict[tuple[str, str], list[int]] = {}
+        for key, entries in buckets.items():
+            entries.sort()
+            self._start_minutes[key] = [minutes for minutes, _ in entries]
+            self._positions[key] = [position for _, position in entries]
+
+        self._by_number_and_section: dict[tuple[str, str], Course] = {}
+        collisions: dict[tuple[str, str], list[Course]] = {}
+        for course in courses:
+            key = (course.number, course.section_number)
+            first = self._by_number_and_section.setdefault(key, course)
+            if first is not course:
+                collisions.setdefault(key, [first]).append(course)
+
+        for (number, section), colliding in collisions.items():
+            logging.warning(f'{len(colliding)} courses share number {number} section {section}; '
+                            f'recordings for it will be matched to {colliding[0]}')
+
+    def __len__(self):
+        return len(self.courses)
+
+    def __iter__(self):
+        return iter(self.courses)
+
+    def find_by_room_and_datetime(self, rec: LectureRecording) -> Course or None:
+        '''
+        Finds the course meeting in the recording's room on the recording's
+        weekday whose start time is within the tolerance of the recording time
+        '''
+        if rec.time is None or rec.date is None:
+            return None
+
+        key = (rec.room_number, WEEKDAYS[rec.date.weekday()])
+        start_minutes = self._start_minutes.get(key)
+        if start_minutes is None:
+            return None
+
+        # A course matches when |course start - recording start| <= tolerance,
+        # so only the starts inside [rec - tolerance, rec + tolerance] can match
+        rec_minutes = rec.time.hour * 60 + rec.time.minute
+        lo = bisect_left(start_minutes, rec_minutes - self.tolerance_minutes)
+        hi = bisect_right(start_minutes, rec_minutes + self.tolerance_minutes)
+        if lo >= hi:
+            return None
+
+        # Several courses can fall in the window; prefer the one listed first
+        return self.courses[min(self._positions[key][lo:hi])]
+
+    def find_by_number_and_section(self, rec: LectureRecording) -> Course or None:
+        '''
+        Finds the course whose number and section match the recording's
+        '''
+        return self._by_number_and_section.get((rec.course_number_full(), rec.section_number))
+
+def get_course_index(courses: list[Course] or CourseIndex, tolerance: timedelta) -> CourseIndex:
+    '''
+    Returns the given courses as a CourseIndex, building one if needed
+    '''
+    if isinstance(courses, CourseIndex):
+        return courses
+    return CourseIndex(courses, tolerance)
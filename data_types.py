@@ -40,6 +40,9 @@ class Recording:
         self.rec_device = rec_device
         self.date = date
         self.time = time
+        self.file_stat: os.stat_result | None = None
+        # Fingerprint of the file's size, head and tail, once something has needed it
+        self.partial_hash: str | None = None
 
     @property
     def filename (self):
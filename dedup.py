@@ -0,0 +1,89 @@
+'''
+Detects recordings that a capture appliance dropped more than once under
+different names, so the copies aren't uploaded or sorted again.
+'''
+
+from collections.abc import Callable
+from data_types import *
+from file_hashing import hash_file, partial_hash
+from threading import Lock
+from time import sleep
+
+# How many times to look for an earlier recording that is being moved
+# while it's hashed, and how long to wait between looks
+MOVED_FILE_ATTEMPTS = 20
+MOVED_FILE_WAIT = 0.05
+
+class DuplicateDetector:
+    '''
+    Remembers every recording it has been shown and reports when a new one
+    has the same contents as an earlier one. Recordings are only compared 
+    when their sizes collide, and then by a partial hash of the head and 
+    tail before paying for a full hash, so a recording of a size not seen 
+    before isn't read at all. The partial hash is kept on the recording 
+    for the job journal to reuse. Safe to share between threads.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._by_size: dict[int, list[LectureRecording]] = {}
+        self._full_hashes: dict[int, str] = {}
+
+    def _size(self, rec: LectureRecording) -> int:
+        return rec.file_stat.st_size if rec.file_stat else os.path.getsize(rec.filepath)
+
+    def _partial_hash(self, rec: LectureRecording, size: int) -> str:
+        if rec.partial_hash is None:
+            rec.partial_hash = hash_current_file(rec, lambda path: partial_hash(path, size))
+        return rec.partial_hash
+
+    def _full_hash(self, rec: LectureRecording) -> str:
+        with self._lock:
+            known = self._full_hashes.get(id(rec))
+        if known is None:
+            known = hash_current_file(rec, hash_file)
+            with self._lock:
+                self._full_hashes[id(rec)] = known
+        return known
+
+    def find_original(self, rec: LectureRecording) -> LectureRecording | None:
+        '''
+        Returns the earlier recording this one duplicates, or None if it is 
+        new, in which case it is remembered for the recordings after it.
+
+        Files are only read outside the lock, so one thread hashing a large
+        recording doesn't hold up the others. A recording is registered 
+        under the lock only once it has been compared with every earlier 
+        one of the same size, including any that were registered while it
+        was being hashed.
+        '''
+        size = self._size(rec)
+        compared = 0
+        while True:
+            with self._lock:
+                same_size = self._by_size.setdefault(size, [])
+                if len(same_size) == compared:
+                    same_size.append(rec)
+                    return None
+                # Recordings are only ever appended, so the ones after compared are new
+                others = same_size[compared:]
+
+            for other in others:
+                if self._partial_hash(other, size) == self._partial_hash(rec, size) and self._full_hash(other) == self._full_hash(rec):
+                    return other
+            compared += len(others)
+
+def hash_current_file(rec: LectureRecording, hasher: Callable[[str], str]) -> str:
+    '''
+    Hashes a recording wherever it is now. An earlier recording may be 
+    moved to its destination while it's being compared, and its filepath 
+    is only updated once the move is done, so a missing file is looked 
+    for again at the recording's new path.
+    '''
+    for _ in range(MOVED_FILE_ATTEMPTS):
+        path = rec.filepath
+        try:
+            return hasher(path)
+        except FileNotFoundError:
+            if rec.filepath == path:
+                sleep(MOVED_FILE_WAIT)
+    return hasher(rec.filepath)
@@ -0,0 +1,31 @@
+'''
+Helpers for fingerprinting recording files by their contents
+'''
+
+import hashlib
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def hash_file(filepath: str) -> str:
+    '''
+    Returns the SHA-256 of the whole file, read a block at a time
+    '''
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+def partial_hash(filepath: str, size: int, sample_size: int = HASH_BLOCK_SIZE) -> str:
+    '''
+    Returns a cheap fingerprint of a file built from its size and the first
+    and last sample_size bytes. Files with different partial hashes are 
+    certainly different; files with the same one still need a full hash.
+    '''
+    digest = hashlib.sha256(str(size).encode())
+    with open(filepath, 'rb') as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(size - sample_size, sample_size))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
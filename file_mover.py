@@ -0,0 +1,106 @@
+'''
+Moves recordings into the destination folder. A move within one
+filesystem is a rename. A move to another device (e.g. local disk to a
+network share) is a kernel-side copy that is checked before the original
+is deleted, so a short or failed copy never costs us the recording.
+'''
+
+from file_hashing import hash_file
+from time import perf_counter
+import errno
+import os
+import shutil
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+VERIFY_MODES = ('size', 'hash')
+
+class MoveResult:
+    '''
+    How a file was moved and how long it took
+    '''
+    def __init__(self, size: int, seconds: float, copied: bool):
+        self.size = size
+        self.seconds = seconds
+        self.copied = copied
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.size / 1_000_000 / max(self.seconds, 1e-6)
+
+    def __str__(self) -> str:
+        if not self.copied:
+            return f'renamed {self.size / 1_000_000:.1f} MB'
+        return f'copied {self.size / 1_000_000:.1f} MB in {self.seconds:.1f}s ({self.mb_per_second:.2f} MB/s)'
+
+def is_same_device(src: str, dest: str) -> bool:
+    '''
+    Whether src and the folder dest will be created in are on the same filesystem
+    '''
+    return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dest))).st_dev
+
+def copy_file_contents(src: str, dest: str) -> int:
+    '''
+    Copies the bytes of src into dest without passing them through Python,
+    using copy_file_range or sendfile where the OS has them. Returns the
+    number of bytes copied.
+    '''
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        for fast_copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if fast_copy is None:
+                continue
+            try:
+                while copied < size:
+                    if fast_copy is os.sendfile:
+                        sent = os.sendfile(fdest.fileno(), fsrc.fileno(), copied, min(COPY_CHUNK_SIZE, size - copied))
+                    else:
+                        sent = os.copy_file_range(fsrc.fileno(), fdest.fileno(), min(COPY_CHUNK_SIZE, size - copied), copied, copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                return copied
+            except OSError as e:
+                # Not supported between these filesystems, so try the next way
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EBADF):
+                    raise
+
+        fsrc.seek(copied)
+        fdest.seek(copied)
+        shutil.copyfileobj(fsrc, fdest, COPY_CHUNK_SIZE)
+        return fdest.tell()
+
+def move_file(src: str, dest: str, verify: str = 'size') -> MoveResult:
+    '''
+    Moves src to dest. Across devices the copy is written next to dest,
+    checked against the original by size (or by SHA-256 with verify='hash'),
+    given the original's timestamps and only then renamed into place and
+    the original deleted.
+    '''
+    start = perf_counter()
+    size = os.path.getsize(src)
+    if is_same_device(src, dest):
+        try:
+            os.replace(src, dest)
+            return MoveResult(size, perf_counter() - start, copied=False)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    partial = f'{dest}.partial'
+    try:
+        copied = copy_file_contents(src, partial)
+        if copied != size or os.path.getsize(partial) != size:
+            raise OSError(f'Copy of {src} is {os.path.getsize(partial)} bytes, expected {size}')
+        if verify == 'hash' and hash_file(partial) != hash_file(src):
+            raise OSError(f'Copy of {src} does not match the original')
+        # Keep the mtime, the reaper goes by it
+        shutil.copystat(src, partial)
+        os.replace(partial, dest)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.remove(src)
+    return MoveResult(size, perf_counter() - start, copied=True)
@@ -1,5 +1,18 @@
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from pathlib import Path
+from threading import Lock
+from time import perf_counter
+import argparse
+import logging
+import os
+import re
+import shutil
+import sqlite3
+
+REAP_WORKERS = 8
+DELETE_BATCH_SIZE = 64
+SEMESTER_FOLDER_REGEX = re.compile(r'(Spring|Summer|Fall)(\d{2})')
 
 def reap_files(target_dir: str, cutoff: datetime) -> list[str]:
     """
@@ -22,3 +35,389 @@ def reap_files(target_dir: str, cutoff: datetime) -> list[str]:
                 deleted_files.append(str(f))
 
     return deleted_files
+
+class ReapStats:
+    """
+    Counts of the work a reap did, for seeing where the time goes on slow shares
+    """
+    def __init__(self):
+        self.dirs_scanned = 0
+        self.entries_seen = 0
+        self.stat_calls = 0
+        self.files_deleted = 0
+        self.dirs_deleted = 0
+        self.bytes_deleted = 0
+        self.semesters_deleted = 0
+        self.semesters_skipped = 0
+        self.scan_seconds = 0.0
+        self.delete_seconds = 0.0
+
+    def __str__(self) -> str:
+        return (f'scanned {self.dirs_scanned} dir(s) and {self.entries_seen} entries with {self.stat_calls} stat call(s) in {self.scan_seconds:.2f}s, '
+                f'deleted {self.semesters_deleted} whole semester(s), {self.files_deleted} file(s) ({self.bytes_deleted / 1_000_000:.1f} MB) and {self.dirs_deleted} dir(s) in {self.delete_seconds:.2f}s, '
+                f'skipped {self.semesters_skipped} newer semester(s)')
+
+class DirListing:
+    """
+    One directory's files as (path, mtime, size) and its subdirectories
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.files: list[tuple[str, float, int]] = []
+        self.subdirs: list[str] = []
+        self.entries = 0
+
+def scan_directory(path: str) -> DirListing:
+    """
+    Lists one directory with os.scandir, which gets file types from the
+    directory listing itself (and the whole stat on Windows) instead of
+    a round trip per entry
+    """
+    listing = DirListing(path)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            listing.entries += 1
+            if entry.is_dir():
+                listing.subdirs.append(entry.path)
+            else:
+                stat = entry.stat()
+                listing.files.append((entry.path, stat.st_mtime, stat.st_size))
+    return listing
+
+def get_semester_range(folder_name: str) -> tuple[datetime, datetime] | None:
+    """
+    Returns when the semester a destination folder (e.g. Fall23) starts 
+    and ends, using the same months as determine_semester, or None if the 
+    folder isn't a semester
+    """
+    match = SEMESTER_FOLDER_REGEX.fullmatch(folder_name)
+    if match is None:
+        return None
+    term, year = match.group(1), 2000 + int(match.group(2))
+    if term == 'Spring':
+        return datetime(year, 1, 1), datetime(year, 5, 1)
+    elif term == 'Summer':
+        return datetime(year, 5, 1), datetime(year, 8, 1)
+    return datetime(year, 8, 1), datetime(year + 1, 1, 1)
+
+def split_semesters(root: str, cutoff: datetime, stats: ReapStats | None = None) -> tuple[list[str], list[str]]:
+    """
+    Sorts the semester folders at the top of the destination into the ones
+    that ended before the cutoff and the ones that started after it. The
+    semester the cutoff falls in is in neither and has to be scanned.
+    """
+    expired: list[str] = []
+    newer: list[str] = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            semester = get_semester_range(entry.name) if entry.is_dir() else None
+            if semester is None:
+                continue
+            start, end = semester
+            if end <= cutoff:
+                expired.append(entry.path)
+            elif start >= cutoff:
+                newer.append(entry.path)
+
+    if stats is not None:
+        stats.dirs_scanned += 1
+        stats.semesters_skipped += len(newer)
+    return expired, newer
+
+def delete_folders(folders: list[str], workers: int = REAP_WORKERS, dry_run: bool = False, stats: ReapStats | None = None) -> list[str]:
+    """
+    Deletes whole folders, several at a time
+    """
+    if dry_run or not folders:
+        return list(folders)
+
+    def delete_folder(folder: str) -> str | None:
+        try:
+            shutil.rmtree(folder)
+            return folder
+        except OSError as e:
+            logging.error(f'Could not delete {folder}: {e}')
+            return None
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reaper') as executor:
+        deleted = [folder for folder in executor.map(delete_folder, folders) if folder is not None]
+    if stats is not None:
+        stats.semesters_deleted += len(deleted)
+        stats.delete_seconds += perf_counter() - start
+    return deleted
+
+def scan_tree(target_dir: str, workers: int = REAP_WORKERS, stats: ReapStats | None = None, skip: set[str] = frozenset()) -> dict[str, DirListing]:
+    """
+    Lists every directory under the target, apart from the ones in skip, 
+    scanning up to `workers` directories at a time
+    """
+    start = perf_counter()
+    tree: dict[str, DirListing] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reaper') as executor:
+        pending = {executor.submit(scan_directory, os.path.abspath(target_dir))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                tree[listing.path] = listing
+                pending |= {executor.submit(scan_directory, subdir) for subdir in listing.subdirs if subdir not in skip}
+                if stats is not None:
+                    stats.dirs_scanned += 1
+                    stats.entries_seen += listing.entries
+                    stats.stat_calls += len(listing.files)
+
+    if stats is not None:
+        stats.scan_seconds += perf_counter() - start
+    return tree
+
+def plan_reap(tree: dict[str, DirListing], root: str, cutoff: datetime) -> tuple[list[tuple[str, int]], list[str]]:
+    """
+    Works out from the scanned tree which files are past the cutoff and 
+    which directories will be empty once they are gone (deepest first), 
+    without listing any directory a second time
+    """
+    cutoff_ts = cutoff.timestamp()
+    expired: list[tuple[str, int]] = []
+    empty_dirs: list[str] = []
+    will_be_empty: dict[str, bool] = {}
+    for path in sorted(tree, key=lambda p: p.count(os.sep), reverse=True):
+        listing = tree[path]
+        expired_here = [(f, size) for f, mtime, size in listing.files if mtime < cutoff_ts]
+        expired.extend(expired_here)
+        will_be_empty[path] = len(expired_here) == len(listing.files) and all(will_be_empty.get(d, False) for d in listing.subdirs)
+        if will_be_empty[path] and path != root:
+            empty_dirs.append(path)
+    return expired, empty_dirs
+
+def delete_batch(paths: list[str]) -> list[str]:
+    deleted = []
+    for path in paths:
+        try:
+            os.unlink(path)
+            deleted.append(path)
+        except OSError as e:
+            logging.error(f'Could not delete {path}: {e}')
+    return deleted
+
+def reap_files_parallel(target_dir: str, cutoff: datetime, workers: int = REAP_WORKERS, dry_run: bool = False, stats: ReapStats | None = None, by_semester: bool = True) -> list[str]:
+    """
+    Does the same as reap_files, but scans the tree concurrently and 
+    deletes in batches on a thread pool. With dry_run nothing is deleted 
+    and the files and directories that would be are returned instead.
+
+    With by_semester, semester folders that ended before the cutoff are 
+    deleted whole and ones that started after it are skipped, so only the 
+    semester the cutoff falls in (and any other folders) are scanned.
+    """
+    root = os.path.abspath(target_dir)
+    expired, newer = split_semesters(root, cutoff, stats) if by_semester else ([], [])
+    deleted = delete_folders(expired, workers, dry_run, stats)
+    tree = scan_tree(root, workers, stats, skip=set(expired + newer))
+    return deleted + reap_tree(tree, root, cutoff, workers, dry_run, stats)
+
+def reap_tree(tree: dict[str, DirListing], root: str, cutoff: datetime, workers: int = REAP_WORKERS, dry_run: bool = False, stats: ReapStats | None = None) -> list[str]:
+    """
+    Deletes what plan_reap finds in an already scanned tree
+    """
+    stats = stats if stats is not None else ReapStats()
+    expired, empty_dirs = plan_reap(tree, root, cutoff)
+    if dry_run:
+        return [f for f, _ in expired] + empty_dirs
+
+    start = perf_counter()
+    sizes = dict(expired)
+    deleted_files: list[str] = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reaper') as executor:
+        batches = [[f for f, _ in expired[i:i + DELETE_BATCH_SIZE]] for i in range(0, len(expired), DELETE_BATCH_SIZE)]
+        for deleted in executor.map(delete_batch, batches):
+            deleted_files.extend(deleted)
+
+    deleted_dirs: list[str] = []
+    for folder in empty_dirs:
+        try:
+            os.rmdir(folder)
+            deleted_dirs.append(folder)
+        except OSError:
+            # Something in it couldn't be deleted
+            pass
+
+    stats.files_deleted += len(deleted_files)
+    stats.bytes_deleted += sum(sizes[f] for f in deleted_files)
+    stats.dirs_deleted += len(deleted_dirs)
+    stats.delete_seconds += perf_counter() - start
+    return deleted_files + deleted_dirs
+
+RETENTION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_mtime ON files (mtime);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+class RetentionIndex:
+    """
+    A persistent table of every file placed in the destination tree and 
+    when it was last modified, so a reap only has to look at the files 
+    past the cutoff instead of walking and stat-ing the whole tree. 
+    Files that get into the tree some other way are picked up by a 
+    periodic full reconciliation. Safe to share between threads.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(RETENTION_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def add(self, path: str, mtime: float | None = None):
+        """
+        Records a file placed in the destination tree
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime if mtime is None else mtime
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files (path, mtime) VALUES (?, ?)', (path, mtime))
+
+    def remove(self, path: str):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(path),))
+
+    def expired(self, cutoff: datetime) -> list[tuple[str, float]]:
+        """
+        Returns the (path, mtime) of every indexed file last modified before the cutoff, oldest first
+        """
+        with self.lock:
+            return self.connection.execute('SELECT path, mtime FROM files WHERE mtime < ? ORDER BY mtime', (cutoff.timestamp(),)).fetchall()
+
+    @property
+    def last_reconciled(self) -> datetime | None:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_reconciled'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def needs_reconcile(self, every: timedelta) -> bool:
+        last = self.last_reconciled
+        return last is None or datetime.now() - last >= every
+
+    def reap(self, target_dir: str, cutoff: datetime) -> list[str]:
+        """
+        Deletes the indexed files older than the cutoff, along with any 
+        directories that leaves empty, without walking the rest of the tree.
+        Entries outside target_dir are dropped from the index rather than 
+        deleted, and a file that can't be deleted is logged and left indexed
+        for the next reap.
+        """
+        deleted_files: list[str] = []
+        root = os.path.abspath(target_dir)
+        for path, _ in self.expired(cutoff):
+            if not path.startswith(root + os.sep):
+                logging.warning(f'Dropping {path} from the retention index, it is outside {root}')
+                self.remove(path)
+                continue
+
+            try:
+                last_modified = os.stat(path).st_mtime
+            except FileNotFoundError:
+                self.remove(path)
+                continue
+            except OSError as e:
+                logging.error(f'Could not check {path}: {e}')
+                continue
+
+            # Touched since it was indexed, so it isn't due yet
+            if last_modified >= cutoff.timestamp():
+                self.add(path, last_modified)
+                continue
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                self.remove(path)
+                continue
+            except OSError as e:
+                logging.error(f'Could not delete {path}: {e}')
+                continue
+            self.remove(path)
+            deleted_files.append(path)
+            deleted_files.extend(remove_empty_parents(path, root))
+
+        return deleted_files
+
+    def reconcile(self, target_dir: str, cutoff: datetime, workers: int = REAP_WORKERS, stats: ReapStats | None = None) -> list[str]:
+        """
+        Reaps the tree with a full scan and then rebuilds the index from 
+        what is left, catching anything the index had drifted on. Semesters
+        newer than the cutoff aren't scanned and keep their index entries.
+        """
+        stats = stats if stats is not None else ReapStats()
+        root = os.path.abspath(target_dir)
+        expired, newer = split_semesters(root, cutoff, stats)
+        deleted_files = delete_folders(expired, workers, stats=stats)
+        tree = scan_tree(root, workers, stats, skip=set(expired + newer))
+        deleted_files += reap_tree(tree, root, cutoff, workers, stats=stats)
+        deleted = set(deleted_files)
+        entries = [(f, mtime) for listing in tree.values() for f, mtime, _ in listing.files if f not in deleted]
+
+        with self.lock, self.connection:
+            rows = self.connection.execute('SELECT path, mtime FROM files').fetchall()
+            entries += [(path, mtime) for path, mtime in rows if any(path.startswith(folder + os.sep) for folder in newer)]
+            self.connection.execute('DELETE FROM files')
+            self.connection.executemany('INSERT INTO files (path, mtime) VALUES (?, ?)', entries)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_reconciled', ?)", (datetime.now().isoformat(timespec='seconds'),))
+        return deleted_files
+
+def remove_empty_parents(path: str, root: str) -> list[str]:
+    """
+    Removes the directories above a deleted file that are now empty, 
+    stopping at the root
+    """
+    removed: list[str] = []
+    folder = os.path.dirname(path)
+    while folder != root and folder.startswith(root + os.sep):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break
+        removed.append(folder)
+        folder = os.path.dirname(folder)
+    return removed
+
+def reap_indexed_files(index: RetentionIndex, target_dir: str, cutoff: datetime, reconcile_every: timedelta = timedelta(days=7), workers: int = REAP_WORKERS, stats: ReapStats | None = None) -> list[str]:
+    """
+    Deletes any files or directories older than the cutoff datetime using
+    the retention index, falling back to a full reconciliation scan when 
+    one is due
+    """
+    if index.needs_reconcile(reconcile_every):
+        return index.reconcile(target_dir, cutoff, workers, stats)
+    return index.reap(target_dir, cutoff)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete recordings older than the retention period from a folder')
+    parser.add_argument('folder')
+    parser.add_argument('--weeks', type=int, default=26, help='How many weeks files are kept')
+    parser.add_argument('--workers', type=int, default=REAP_WORKERS, help='How many directories are scanned at the same time')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    parser.add_argument('--no-semesters', action='store_true', help='Scan every file instead of deleting and skipping whole semester folders')
+    args = parser.parse_args()
+
+    stats = ReapStats()
+    cutoff = datetime.now() - timedelta(weeks=args.weeks)
+    reaped = reap_files_parallel(args.folder, cutoff, args.workers, args.dry_run, stats, by_semester=not args.no_semesters)
+    for f in reaped:
+        print(f'{"Would delete" if args.dry_run else "Deleted"}: {f}')
+    print(f'{len(reaped)} file(s) and folder(s) {"would be " if args.dry_run else ""}deleted')
+    print(f'Reaper {stats}')
@@ -0,0 +1,157 @@
+'''
+Notices recordings as they land in the watch folder, so they can be sorted
+within a minute or two of the capture finishing instead of at 3 AM. A file
+is only handed out once its size and mtime have stopped changing for a
+while, so captures that are still being written are left alone.
+
+Filesystem events come from the optional watchdog package (inotify on
+Linux, ReadDirectoryChangesW on Windows). Without it the folder is polled.
+'''
+
+from threading import Event, Lock
+from time import monotonic, sleep
+import logging
+import os
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+class RecordingEventHandler(FileSystemEventHandler):
+    '''
+    Passes watchdog's create/modify/move events on to the watcher
+    '''
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        self.watcher.notice(event.src_path)
+
+    def on_modified(self, event):
+        self.watcher.notice(event.src_path)
+
+    def on_moved(self, event):
+        self.watcher.notice(event.dest_path)
+
+class RecordingWatcher:
+    '''
+    Tracks the .mp4 files in a folder until they are stable. Safe to feed
+    from the watchdog thread while the main thread takes stable files.
+
+    A capture being written fires modify events many times a second, so 
+    wait() never returns sooner than check_interval seconds after the last
+    take_stable(), and pending files are re-stat-ed at most that often.
+    '''
+    def __init__(self, watch_path: str, settle_seconds: float = 60, use_events: bool = True, check_interval: float = 0):
+        self.watch_path = watch_path
+        self.settle_seconds = settle_seconds
+        self.use_events = use_events
+        self.check_interval = check_interval
+        self._last_checked: float | None = None
+        self._lock = Lock()
+        self._changed = Event()
+        # path -> (size, mtime_ns, when that size/mtime was first seen)
+        self._pending: dict[str, tuple[int, int, float]] = {}
+        # path -> (size, mtime_ns) of files already handed out, so a file that
+        # failed to move isn't handed out again until it changes
+        self._handled: dict[str, tuple[int, int]] = {}
+        self._observer = None
+
+    @property
+    def using_events(self) -> bool:
+        return self._observer is not None
+
+    def start(self):
+        if self.use_events and Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(RecordingEventHandler(self), self.watch_path, recursive=False)
+            self._observer.start()
+            logging.info(f'Watching {self.watch_path} for new recordings')
+        else:
+            if self.use_events:
+                logging.warning('watchdog is not installed, polling the watch folder instead')
+            logging.info(f'Polling {self.watch_path} for new recordings')
+        self.poll()
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def notice(self, path: str):
+        '''
+        Starts tracking a file that was created or changed
+        '''
+        if not path.endswith('.mp4'):
+            return
+        with self._lock:
+            self._pending.setdefault(os.path.abspath(path), (-1, -1, monotonic()))
+        self._changed.set()
+
+    def poll(self) -> int:
+        '''
+        Lists the folder and starts tracking any recordings not seen yet.
+        Returns how many there were.
+        '''
+        found = 0
+        with os.scandir(self.watch_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.mp4') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                path = os.path.abspath(entry.path)
+                with self._lock:
+                    if path in self._pending or self._handled.get(path) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    self._pending[path] = (-1, -1, monotonic())
+                found += 1
+        return found
+
+    def wait(self, timeout: float):
+        '''
+        Sleeps until a filesystem event arrives or the timeout passes, and
+        at least until check_interval has passed since the last take_stable
+        '''
+        self._changed.wait(timeout)
+        self._changed.clear()
+        if self._last_checked is not None:
+            remaining = self._last_checked + self.check_interval - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+
+    def take_stable(self) -> list[str]:
+        '''
+        Returns the tracked files whose size and mtime haven't changed for
+        settle_seconds, and stops tracking them
+        '''
+        now = monotonic()
+        self._last_checked = now
+        stable: list[str] = []
+        with self._lock:
+            for path, (size, mtime_ns, since) in list(self._pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - since >= self.settle_seconds:
+                    del self._pending[path]
+                    self._handled[path] = (size, mtime_ns)
+                    stable.append(path)
+        return stable
+
+    def forget_handled(self):
+        '''
+        Lets files that were handed out but are still in the folder (e.g.
+        because their move failed) be picked up again by the next poll
+        '''
+        with self._lock:
+            self._handled.clear()
@@ -6,6 +6,7 @@ information, or the successfully created LectureRecording instance.
 '''
 
 from data_types import *
+from collections.abc import Callable
 import re
 
 def old_extron_format_parser(filepath: str) -> LectureRecording or None:
@@ -20,44 +21,102 @@ def old_extron_format_parser(filepath: str) -> LectureRecording or None:
     else:
         return None
     
-def extron_format_parser(filepath: str) -> LectureRecording or None:
-    filename = os.path.basename(filepath)
-    extron_pattern = r'(\d+)_.*?_(\d{8})-(\d{6})_[sS]1[rR]1.mp4'
-    match_extron = re.match(extron_pattern, filename)
-    if match_extron:
-        room_number, rec_date, rec_time = match_extron.groups()
-        dt = datetime.strptime(f'{rec_date}{rec_time}', '%Y%m%d%H%M%S')
-        rec = LectureRecording(filepath, dt.date(), dt.time(), room_number, 'extron')
-        return rec
-    else:
+class RecordingFormat:
+    '''
+    A filename format produced by one kind of recording device. The pattern
+    uses named groups prefixed with the format's name so that every format 
+    can be combined into a single alternation.
+    '''
+    def __init__(self, name: str, pattern: str, build):
+        self.name = name
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.build: Callable[[str, re.Match], LectureRecording] = build
+
+    def parse(self, filepath: str) -> LectureRecording or None:
+        match = self.regex.match(os.path.basename(filepath))
+        return self.build(filepath, match) if match else None
+
+def _group_date(match: re.Match, prefix: str) -> date:
+    return date(int(match.group(f'{prefix}_year')), int(match.group(f'{prefix}_month')), int(match.group(f'{prefix}_day')))
+
+def _group_time(match: re.Match, prefix: str) -> time:
+    return time(int(match.group(f'{prefix}_hour')), int(match.group(f'{prefix}_minute')), int(match.group(f'{prefix}_second')))
+
+def _datetime_pattern(prefix: str) -> str:
+    return (f'(?P<{prefix}_year>\\d{{4}})(?P<{prefix}_month>\\d{{2}})(?P<{prefix}_day>\\d{{2}})-'
+            f'(?P<{prefix}_hour>\\d{{2}})(?P<{prefix}_minute>\\d{{2}})(?P<{prefix}_second>\\d{{2}})')
+
+def _build_extron(filepath: str, match: re.Match) -> LectureRecording:
+    return LectureRecording(filepath, _group_date(match, 'extron'), _group_time(match, 'extron'), match.group('extron_room'), 'extron')
+
+def _build_capturecast(filepath: str, match: re.Match) -> LectureRecording:
+    return LectureRecording(filepath, _group_date(match, 'capturecast'), None, None, 'capturecast', 
+                            match.group('capturecast_number'), match.group('capturecast_section'), match.group('capturecast_code'))
+
+def _build_extron_2100(filepath: str, match: re.Match) -> LectureRecording:
+    return LectureRecording(filepath, _group_date(match, 'extron_2100'), _group_time(match, 'extron_2100'), '2100', 'extron_2100')
+
+EXTRON_FORMAT = RecordingFormat(
+    'extron',
+    f'(?P<extron_room>\\d+)_.*?_{_datetime_pattern("extron")}_[sS]1[rR]1.mp4',
+    _build_extron
+)
+CAPTURECAST_FORMAT = RecordingFormat(
+    'capturecast',
+    r'(?P<capturecast_code>\w+)-(?P<capturecast_number>\d+)-(?P<capturecast_section>\d+)---(?P<capturecast_month>\d{1,2})-(?P<capturecast_day>\d{1,2})-(?P<capturecast_year>\d{4}).mp4',
+    _build_capturecast
+)
+EXTRON_2100_FORMAT = RecordingFormat(
+    'extron_2100',
+    f'SMP-2100_{_datetime_pattern("extron_2100")}_[sS]1[rR]1.mp4',
+    _build_extron_2100
+)
+
+# The order matters: a filename is parsed by the first format that matches it
+RECORDING_FORMATS: list[RecordingFormat] = [EXTRON_FORMAT, CAPTURECAST_FORMAT, EXTRON_2100_FORMAT]
+_FORMATS_BY_NAME = {fmt.name: fmt for fmt in RECORDING_FORMATS}
+
+# Every format in one alternation, so a filename is only scanned by one compiled regex.
+# Python tries alternatives left to right, which keeps the same precedence as RECORDING_FORMATS.
+RECORDING_FORMAT_REGEX = re.compile('|'.join(f'(?P<{fmt.name}>{fmt.pattern})' for fmt in RECORDING_FORMATS))
+
+def parse_recording_filename(filepath: str) -> LectureRecording or None:
+    '''
+    Parses a recording with whichever supported format matches its filename
+    '''
+    match = RECORDING_FORMAT_REGEX.match(os.path.basename(filepath))
+    if match is None:
         return None
+    return _FORMATS_BY_NAME[match.lastgroup].build(filepath, match)
+
+def extron_format_parser(filepath: str) -> LectureRecording or None:
+    return EXTRON_FORMAT.parse(filepath)
 
 def capturecast_format_parser(filepath: str) -> LectureRecording or None:
-    filename = os.path.basename(filepath)
-    capturecast_pattern = r'(\w+)-(\d+)-(\d+)---(\d{1,2})-(\d{1,2})-(\d{4}).mp4'
-    match_capturecast = re.match(capturecast_pattern, filename)
-    if match_capturecast:
-        course_code, course_number, section_number, month, day, year = match_capturecast.groups()
-        rec_date = date(int(year), int(month), int(day))
-        rec = LectureRecording(filepath, rec_date, None, None, 'capturecast', course_number, section_number, course_code)
-        return rec
-    else:
-        return None
+    return CAPTURECAST_FORMAT.parse(filepath)
     
 def extron_2100_format_parser(filepath: str) -> LectureRecording or None:
-    filename = os.path.basename(filepath)
-    extron_2100_pattern = r'SMP-2100_(\d{8})-(\d{6})_[sS]1[rR]1.mp4'
-    match_extron_2100 = re.match(extron_2100_pattern, filename)
-
-    if match_extron_2100:
-        rec_date, rec_time = match_extron_2100.groups()
-        room_number = '2100'
-        dt = datetime.strptime(f'{rec_date}{rec_time}', '%Y%m%d%H%M%S')
-        rec = LectureRecording(filepath, dt.date(), dt.time(), room_number, 'extron_2100')
-        return rec
+    return EXTRON_2100_FORMAT.parse(filepath)
+    
+def format_recording_filename(rec: LectureRecording) -> str or None:
+    '''
+    The inverse of the parsers above: builds the filename a device would 
+    have given the recording. Used to generate test and benchmark files.
+    '''
+    if rec.rec_device == 'extron':
+        stringdate = rec.date.strftime("%Y%m%d")
+        stringtime = rec.time.strftime("%H%M%S")
+        return f'{rec.room_number}_{stringdate}-1_{stringdate}-{stringtime}_S1R1.mp4'
+    elif rec.rec_device == 'extron_2100':
+        stringdate = rec.date.strftime("%Y%m%d")
+        stringtime = rec.time.strftime("%H%M%S")
+        return f'SMP-2100_{stringdate}-{stringtime}_S1R1.mp4'
+    elif rec.rec_device == 'capturecast':
+        return f'{rec.course_code}-{rec.course_number}-{rec.section_number}---{rec.date.month}-{rec.date.day}-{rec.date.year}.mp4'
     else:
         return None
-    
+
 # CURRENTLY UNUSED
 def manual_format_parser(filepath: str) -> Recording or None:
     filename = os.path.basename(filepath)
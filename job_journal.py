@@ -0,0 +1,182 @@
+'''
+A durable SQLite journal of every recording the sorter handles. Each
+recording gets a job recording where it came from, what it matched, what
+was uploaded and where it was moved, along with every state it went
+through. If the process dies partway through, the next run picks the
+job back up instead of redoing finished steps (e.g. uploading a file to
+Kaltura a second time because it crashed before the move).
+
+To see what happened to a file:
+
+    python job_journal.py journal.sqlite3 4603_20231114-1_20231114-142800_S1R1.mp4
+'''
+
+from data_types import *
+from file_hashing import partial_hash
+from threading import Lock
+import sqlite3
+import sys
+
+# A job moves through these states; 'moved' and 'duplicate' are the finished ones
+MATCHED = 'matched'
+UNMATCHED = 'unmatched'
+UPLOADING = 'uploading'
+UPLOADED = 'uploaded'
+UPLOAD_FAILED = 'upload_failed'
+MOVED = 'moved'
+MOVE_FAILED = 'move_failed'
+DUPLICATE = 'duplicate'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    content_hash TEXT,
+    course TEXT,
+    upload_token TEXT,
+    entry_ids TEXT NOT NULL DEFAULT '',
+    dest_path TEXT,
+    state TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_source ON jobs (source_path, size, mtime_ns);
+CREATE INDEX IF NOT EXISTS jobs_by_filename ON jobs (filename);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    state TEXT NOT NULL,
+    detail TEXT,
+    at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_by_job ON transitions (job_id);
+'''
+
+JOB_COLUMNS = ('id', 'source_path', 'filename', 'size', 'mtime_ns', 'content_hash', 'course', 'upload_token', 'entry_ids', 'dest_path', 'state', 'created_at', 'updated_at')
+
+class Job:
+    '''
+    One recording's row in the journal
+    '''
+    def __init__(self, row: tuple):
+        for column, value in zip(JOB_COLUMNS, row):
+            setattr(self, column, value)
+
+    @property
+    def entry_id_list(self) -> list[str]:
+        '''
+        The Kaltura entries created for this recording, one per upload
+        '''
+        return self.entry_ids.split(',') if self.entry_ids else []
+
+    def __str__(self) -> str:
+        return f'Job(id={self.id}, filename={self.filename}, state={self.state}, course={self.course}, entries={self.entry_ids or None}, dest={self.dest_path})'
+
+class JobJournal:
+    '''
+    The journal database. Safe to share between the upload worker threads.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _now(self) -> str:
+        return datetime.now().isoformat(timespec='seconds')
+
+    def _get(self, job_id: int) -> Job:
+        row = self.connection.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job(row)
+
+    def open_job(self, rec: LectureRecording, course: Course | None, hash_contents: bool = False) -> Job:
+        '''
+        Returns the unfinished job for this exact file (same path, size and
+        mtime) if an earlier run left one behind, otherwise starts a new one.
+        A job whose upload failed is unfinished, so the next pass retries it.
+        New jobs store a fingerprint of the file if hash_contents is True, 
+        the partial hash of its size and first and last megabyte, so 
+        journalling doesn't read every recording in full before it's uploaded.
+        A partial hash the duplicate detector already took is reused.
+        '''
+        stat = rec.file_stat or os.stat(rec.filepath)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE source_path = ? AND size = ? AND mtime_ns = ? AND state NOT IN (?, ?) ORDER BY id DESC LIMIT 1',
+                (rec.filepath, stat.st_size, stat.st_mtime_ns, MOVED, DUPLICATE)
+            ).fetchone()
+            if row is not None:
+                return Job(row)
+
+        content_hash = None
+        if hash_contents:
+            content_hash = rec.partial_hash or partial_hash(rec.filepath, stat.st_size)
+            rec.partial_hash = content_hash
+        with self.lock, self.connection:
+            now = self._now()
+            state = MATCHED if course is not None else UNMATCHED
+            cursor = self.connection.execute(
+                'INSERT INTO jobs (source_path, filename, size, mtime_ns, content_hash, course, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (rec.filepath, rec.filename, stat.st_size, stat.st_mtime_ns, content_hash, str(course) if course else None, state, now, now)
+            )
+            self.connection.execute('INSERT INTO transitions (job_id, state, at) VALUES (?, ?, ?)', (cursor.lastrowid, state, now))
+            return self._get(cursor.lastrowid)
+
+    def transition(self, job: Job, state: str, detail: str | None = None, **fields) -> Job:
+        '''
+        Moves a job to a new state, updating any of its other columns given
+        as keyword arguments, and refreshes the job object in place
+        '''
+        now = self._now()
+        updates = {**fields, 'state': state, 'updated_at': now}
+        assignments = ', '.join(f'{column} = ?' for column in updates)
+        with self.lock, self.connection:
+            self.connection.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*updates.values(), job.id))
+            self.connection.execute('INSERT INTO transitions (job_id, state, detail, at) VALUES (?, ?, ?, ?)', (job.id, state, detail, now))
+            job.__dict__.update(self._get(job.id).__dict__)
+        return job
+
+    def add_entry(self, job: Job, upload_token: str, entry_id: str) -> Job:
+        '''
+        Records a finished upload of the job's recording
+        '''
+        entry_ids = ','.join(job.entry_id_list + [entry_id])
+        return self.transition(job, UPLOADED, f'entry {entry_id}', upload_token=upload_token, entry_ids=entry_ids)
+
+    def history(self, name: str) -> list[tuple[Job, list[tuple[str, str, str]]]]:
+        '''
+        Finds every job for a file, by its original path, original filename
+        or the path it was moved to, along with its (state, detail, time) transitions
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE filename = ? OR source_path = ? OR dest_path = ? ORDER BY id',
+                (os.path.basename(name), name, name)
+            ).fetchall()
+            result = []
+            for row in rows:
+                job = Job(row)
+                transitions = self.connection.execute('SELECT state, detail, at FROM transitions WHERE job_id = ? ORDER BY id', (job.id,)).fetchall()
+                result.append((job, transitions))
+        return result
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'Usage: python {sys.argv[0]} <journal file> <recording filename or path>')
+        sys.exit(1)
+
+    journal = JobJournal(sys.argv[1])
+    history = journal.history(sys.argv[2])
+    if not history:
+        print(f'No record of {sys.argv[2]}')
+    for job, transitions in history:
+        print(job)
+        for state, detail, at in transitions:
+            print(f'  {at}  {state}{f"  ({detail})" if detail else ""}')
@@ -0,0 +1,272 @@
+'''
+A small local stand-in for the parts of the Kaltura API that
+mock_kaltura_client.py talks to. It keeps everything in memory and is
+meant for tests and load tests, so uploads can be exercised without 
+touching kaltura.com.
+
+    server = KalturaStandIn(latency=0.05, error_rate=0.01)
+    server.start()
+    client = KalturaClient(KalturaConfiguration(serviceUrl=server.service_url))
+    ...
+    server.stop()
+
+Besides failing chosen calls, it can slow every request down by a fixed 
+latency, cap how fast request bodies are received, and fail or expire 
+the session of a random share of requests.
+'''
+
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import urlparse, parse_qs
+import json
+import random
+import re
+
+class KalturaStandIn:
+    '''
+    An in-memory Kaltura API served over HTTP on localhost
+    '''
+    def __init__(self, partner_id='12345', latency: float = 0, bandwidth: float = 0, error_rate: float = 0, expire_rate: float = 0, keep_uploads: bool = True, seed: int = 0):
+        self.partner_id = partner_id
+        # Seconds added to every request, and the bytes per second each 
+        # connection's request bodies are received at (0 for no cap)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # Share of requests answered with fail_status, and of requests 
+        # whose session is expired just before they are handled
+        self.error_rate = error_rate
+        self.expire_rate = expire_rate
+        # Without keep_uploads only the size of uploaded files is kept, 
+        # so a load test doesn't hold every file in memory
+        self.keep_uploads = keep_uploads
+        self.random = random.Random(seed)
+        self.injected_errors = 0
+        self.injected_expiries = 0
+        self.lock = Lock()
+        self.upload_tokens: dict[str, dict] = {}
+        self.media_entries: dict[str, dict] = {}
+        self.calls: list[tuple[str, dict]] = []
+        # Makes the nth call (0 based) to an action fail with fail_status, e.g. {'uploadtoken.upload': {2}}
+        self.fail_calls: dict[str, set[int]] = {}
+        self.fail_status = 500
+        self.connections = 0
+        # HTTP requests received, counting a multirequest once
+        self.requests = 0
+        # Sessions answered with an EXPIRED_KS error, and how long new sessions last
+        self.expired_sessions: set[str] = set()
+        self.session_lifetime = 14400
+        self._call_counts: dict[str, int] = {}
+        self._next_id = 0
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: Thread | None = None
+
+    @property
+    def service_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api_v3/service'
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so clients can keep connections alive between requests
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, which Nagle's 
+            # algorithm would otherwise hold up for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with standin.lock:
+                    standin.connections += 1
+
+            def do_POST(self):
+                standin._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def calls_to(self, action: str) -> list[dict]:
+        return [params for name, params in self.calls if name == action]
+
+    def _new_id(self, prefix: str) -> str:
+        with self.lock:
+            self._next_id += 1
+            return f'{prefix}_{self._next_id}'
+
+    def _handle(self, request: BaseHTTPRequestHandler):
+        with self.lock:
+            self.requests += 1
+        url = urlparse(request.path)
+        match = re.fullmatch(r'/api_v3/service/(\w+)/action/(\w+)', url.path)
+        if url.path == '/api_v3/service/multirequest':
+            action = 'multirequest'
+        elif match is None:
+            self._respond(request, 404, {'message': f'Unknown path {url.path}'})
+            return
+        else:
+            action = f'{match.group(1).lower()}.{match.group(2)}'
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+        delay = self.latency + (len(body) / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            sleep(delay)
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=default_policy).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            for part in message.iter_parts():
+                params[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+        elif body:
+            params.update(json.loads(body))
+
+        with self.lock:
+            fail = self.random.random() < self.error_rate
+            # Sessions are only expired once started, not while starting them
+            expire = (self.random.random() < self.expire_rate and params.get('ks') is not None 
+                      and action.split('.')[0] not in ('session', 'apptoken'))
+            if fail:
+                self.injected_errors += 1
+            if expire:
+                self.injected_expiries += 1
+                self.expired_sessions.add(params['ks'])
+        if fail:
+            self._respond(request, self.fail_status, {'message': 'Injected failure'})
+            return
+
+        if action == 'multirequest':
+            status, result = self._multirequest(params)
+        else:
+            status, result = self._call(action, params)
+        self._respond(request, status, result)
+
+    def _call(self, action: str, params: dict) -> tuple[int, dict | list]:
+        with self.lock:
+            call_number = self._call_counts.get(action, 0)
+            self._call_counts[action] = call_number + 1
+            self.calls.append((action, {k: v for k, v in params.items() if not isinstance(v, bytes)}))
+        if call_number in self.fail_calls.get(action, set()):
+            return self.fail_status, {'message': 'Injected failure'}
+
+        if params.get('ks') in self.expired_sessions:
+            return 200, self._error('EXPIRED_KS', f'KS {params["ks"]} has expired')
+
+        handler = getattr(self, f'_action_{action.replace(".", "_")}', None)
+        if handler is None:
+            return 404, {'message': f'Unknown action {action}'}
+        return 200, handler(params)
+
+    def _multirequest(self, params: dict) -> tuple[int, dict | list]:
+        """
+        Runs the numbered calls in a multirequest in order, filling in 
+        {n:result:field} references with the results of earlier calls
+        """
+        status, result = self._call('multirequest', {k: v for k, v in params.items() if not k.isdigit()})
+        if status != 200 or result is not None:
+            return status, result
+
+        results = []
+        for key in sorted((k for k in params if k.isdigit()), key=int):
+            call = dict(params[key])
+            action = f'{call.pop("service").lower()}.{call.pop("action")}'
+            call.setdefault('ks', params.get('ks'))
+            status, result = self._call(action, self._resolve(call, results))
+            results.append(result if status == 200 else self._error('INTERNAL_SERVER_ERROR', result.get('message')))
+        return 200, results
+
+    def _resolve(self, value, results: list):
+        if isinstance(value, dict):
+            return {k: self._resolve(v, results) for k, v in value.items()}
+        match = re.fullmatch(r'\{(\d+):result:(\w+)\}', value) if isinstance(value, str) else None
+        if match is None:
+            return value
+        earlier = results[int(match.group(1)) - 1]
+        return earlier.get(match.group(2)) if isinstance(earlier, dict) else None
+
+    def _action_multirequest(self, params):
+        # The calls themselves are handled by _multirequest
+        return None
+
+    def _respond(self, request: BaseHTTPRequestHandler, status: int, result: dict):
+        data = json.dumps(result).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _error(self, code: str, message: str) -> dict:
+        return {'objectType': 'KalturaAPIException', 'code': code, 'message': message}
+
+    def _action_session_startWidgetSession(self, params):
+        return {'ks': self._new_id('widgetks'), 'partnerId': self.partner_id, 'userId': 0}
+
+    def _action_apptoken_startSession(self, params):
+        return {'ks': self._new_id('ks'), 'partnerId': self.partner_id, 'userId': '', 'expiry': int(time()) + self.session_lifetime}
+
+    def _action_uploadtoken_add(self, params):
+        token_id = self._new_id('token')
+        with self.lock:
+            self.upload_tokens[token_id] = {'id': token_id, 'data': bytearray(), 'size': 0, 'finished': False}
+        return {'id': token_id, 'uploadedFileSize': 0}
+
+    def _action_uploadtoken_get(self, params):
+        token = self.upload_tokens.get(params.get('uploadTokenId'))
+        if token is None:
+            return self._error('UPLOAD_TOKEN_NOT_FOUND', 'Upload token not found')
+        return {'id': token['id'], 'uploadedFileSize': token['size']}
+
+    def _action_uploadtoken_upload(self, params):
+        token = self.upload_tokens.get(params.get('uploadTokenId'))
+        if token is None:
+            return self._error('UPLOAD_TOKEN_NOT_FOUND', 'Upload token not found')
+
+        resume = params.get('resume') == 'true'
+        resume_at = int(params.get('resumeAt', 0))
+        chunk = params.get('fileData', b'')
+        with self.lock:
+            if not resume:
+                token['data'] = bytearray()
+                token['size'] = 0
+            elif resume_at != token['size']:
+                return self._error('UPLOAD_TOKEN_RESUMING_INVALID_POSITION', f'Expected resumeAt {token["size"]}, got {resume_at}')
+            if self.keep_uploads:
+                token['data'] += chunk
+            token['size'] += len(chunk)
+            token['finished'] = params.get('finalChunk') == 'true'
+            return {'id': token['id'], 'uploadedFileSize': token['size']}
+
+    def _action_media_add(self, params):
+        entry = dict(params.get('entry', {}))
+        entry['id'] = self._new_id('0_entry')
+        entry.setdefault('description', None)
+        with self.lock:
+            self.media_entries[entry['id']] = entry
+        return entry
+
+    def _action_media_addContent(self, params):
+        entry = self.media_entries.get(params.get('entryId'))
+        if entry is None:
+            return self._error('ENTRY_ID_NOT_FOUND', 'Entry not found')
+        with self.lock:
+            entry['uploadTokenId'] = params['resource']['token']
+        return entry
+
+    def _action_user_getByLoginId(self, params):
+        # Every user exists, with the same id as their login
+        return {'id': params.get('loginId'), 'loginId': params.get('loginId')}
+
+    def _action_user_get(self, params):
+        return {'id': params.get('userId'), 'loginId': params.get('userId')}
@@ -4,29 +4,83 @@ from data_types import *
 from mock_kaltura_client import *
 import os
 import hashlib
+import json
+import logging
+import requests
+from threading import Lock
+from time import sleep
 
-def get_kaltura_client() -> KalturaClient:
+def start_kaltura_session(client: KalturaClient, expiry: int = 14400) -> KalturaClient.SessionData:
     '''
-    Returns a "handle" for the KalturaClient, representing 
-    one "conversation" with the Kaltura API.
+    Starts a new Kaltura session (KS) using the app token and returns it.
+    The client's current session is left alone, so requests other threads
+    are sending with it aren't affected until the caller swaps it in.
     '''
-    config = KalturaConfiguration()
-    client = KalturaClient(config)
-
     widgetId = f"_{os.environ['PARTNER_ID']}"
-    expiry = 14400
 
-    result = client.session.startWidgetSession(widgetId, expiry)
+    widgetSession = client.session.startWidgetSession(widgetId, expiry)
 
     # Authenticate the session
-    hashString = hashlib.sha256((result.ks + os.environ['TOKEN']).encode('ascii')).hexdigest() # Create a hash of the token, so we don't need to transmit the unencrypted token.
-    result = client.appToken.startSession(
+    hashString = hashlib.sha256((widgetSession.ks + os.environ['TOKEN']).encode('ascii')).hexdigest() # Create a hash of the token, so we don't need to transmit the unencrypted token.
+    session = client.appToken.startSession(
         id=os.environ['TOKEN_ID'],
         tokenHash=hashString,
+        session=widgetSession,
     )
+    if session.expiry is None:
+        session.expiry = datetime.now().timestamp() + expiry
+    return session
 
+def get_kaltura_client(config: KalturaConfiguration | None = None) -> KalturaClient:
+    '''
+    Returns a "handle" for the KalturaClient, representing 
+    one "conversation" with the Kaltura API.
+    '''
+    client = KalturaClient(config or KalturaConfiguration())
+    client.sessionData = start_kaltura_session(client)
     return client
 
+class KalturaSessionManager:
+    '''
+    Keeps one KalturaClient and its session around between runs. The 
+    session is renewed once it is within renew_before seconds of expiring,
+    and if the API reports it expired partway through a batch, the client 
+    re-authenticates and retries the failed call instead of failing it.
+    '''
+    def __init__(self, config: KalturaConfiguration | None = None, expiry: int = 14400, renew_before: int = 600):
+        self.config = config or KalturaConfiguration()
+        self.expiry = expiry
+        self.renew_before = renew_before
+        self.client: KalturaClient | None = None
+        self.lock = Lock()
+
+    def get_client(self) -> KalturaClient:
+        '''
+        Returns the client, starting or renewing its session if needed
+        '''
+        with self.lock:
+            if self.client is None:
+                client = KalturaClient(self.config)
+                client.onSessionExpired = self.renew
+                client.sessionData = start_kaltura_session(client, self.expiry)
+                self.client = client
+                logging.info('Started a new Kaltura session')
+            elif datetime.now().timestamp() >= self.client.sessionData.expiry - self.renew_before:
+                self.client.sessionData = start_kaltura_session(self.client, self.expiry)
+                logging.info('Renewed the Kaltura session before it expired')
+            return self.client
+
+    def renew(self, expired_ks: str):
+        '''
+        Starts a new session after the API rejected expired_ks, the KS the 
+        failed request was sent with. When several uploads hit the same 
+        expired session only the first one renews it; the others find a 
+        newer session already in place and just resend with it.
+        '''
+        with self.lock:
+            if self.client.sessionData.ks == expired_ks:
+                logging.warning('Kaltura session expired mid-run, re-authenticating')
+                self.client.sessionData = start_kaltura_session(self.client, self.expiry)
 
 ####################################### ABOUT AUTHENTICATION #######################################
 # A hash is a one-way function, you input data and it returns a fixed length "signature" of that 
@@ -39,21 +93,133 @@ def get_kaltura_client() -> KalturaClient:
 #####################################################################################################
 
 
-def upload_video (rec: LectureRecording, course: Course, kaltura_client: KalturaClient, kaltura_name, instructorIndex: int = -1):
-    # File uploading
-    ## Step 1: Get an upload token. This pre-assigns an identifer to the file we are about to upload.
-    uploadToken = KalturaUploadToken()
-    token = kaltura_client.uploadToken.add(uploadToken)
+def get_upload_state_path(filepath: str) -> str:
+    return f'{filepath}.upload.json'
+
+def load_upload_state(filepath: str, size: int, mtime_ns: int) -> dict | None:
+    '''
+    Returns the saved progress of an interrupted chunked upload of this 
+    file, or None if there isn't one or the file has changed since
+    '''
+    state_path = get_upload_state_path(filepath)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f'Ignoring unreadable upload state {state_path}: {e}')
+        return None
+
+    if state.get('size') != size or state.get('mtime_ns') != mtime_ns:
+        return None
+    return state
+
+def save_upload_state(filepath: str, state: dict):
+    state_path = get_upload_state_path(filepath)
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def upload_file_in_chunks(kaltura_client: KalturaClient, filepath: str, chunk_size: int) -> str:
+    '''
+    Uploads a file in chunks of chunk_size bytes and returns the upload token id.
+
+    Only one chunk is held in memory at a time. After every acknowledged 
+    chunk the token id and offset are saved next to the file, so if the 
+    upload is interrupted the next call carries on from the last 
+    acknowledged byte with the same upload token instead of starting over.
+
+    A chunk that fails with a 5xx or a dropped connection is retried up to
+    the client's configured retries, with backoff, from however many bytes
+    Kaltura reports it already has, so one bad request doesn't leave the 
+    whole recording for the next pass.
+    '''
+    stat = os.stat(filepath)
+    state = load_upload_state(filepath, stat.st_size, stat.st_mtime_ns)
+    if state is None:
+        token = kaltura_client.uploadToken.add(KalturaUploadToken())
+        state = {'uploadTokenId': token.id, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'offset': 0}
+        save_upload_state(filepath, state)
+    elif state['offset'] > 0:
+        # A chunk whose answer was lost may still have reached Kaltura, so 
+        # carry on from the server's count rather than the saved one
+        uploaded = kaltura_client.uploadToken.get(state['uploadTokenId']).uploadedFileSize
+        if uploaded is not None:
+            state['offset'] = uploaded
+        logging.info(f'Resuming upload of {filepath} at byte {state["offset"]} of {stat.st_size}')
+
+    filename = os.path.basename(filepath)
+    attempt = 0
+    with open(filepath, 'rb') as f:
+        f.seek(state['offset'])
+        while True:
+            chunk = f.read(chunk_size)
+            offset = state['offset']
+            final_chunk = offset + len(chunk) >= stat.st_size
+            try:
+                result = kaltura_client.uploadToken.upload(state['uploadTokenId'], (filename, chunk), offset > 0, final_chunk, offset)
+            except requests.RequestException as e:
+                if attempt >= kaltura_client.config.retries:
+                    raise
+                logging.warning(f'Chunk at byte {offset} of {filepath} failed, retrying: {e}')
+                sleep(kaltura_client.config.backoffFactor * 2 ** attempt)
+                attempt += 1
+                kaltura_client._countRetries(1)
+                # The chunk may have arrived even though its answer didn't
+                uploaded = kaltura_client.uploadToken.get(state['uploadTokenId']).uploadedFileSize
+                if uploaded is not None:
+                    state['offset'] = uploaded
+                f.seek(state['offset'])
+                continue
+            attempt = 0
+
+            # The server's count of received bytes is the acknowledged offset, when it reports one
+            state['offset'] = result.uploadedFileSize if result.uploadedFileSize is not None else offset + len(chunk)
+            if final_chunk:
+                break
+            save_upload_state(filepath, state)
+            f.seek(state['offset'])
+
+    os.remove(get_upload_state_path(filepath))
+    return state['uploadTokenId']
+
+def create_media_entry (kaltura_client: KalturaClient, mediaEntry: KalturaMediaEntry, uploadTokenId: str | None = None) -> tuple[str, str]:
+    '''
+    Creates an upload token (unless one is given), the media entry, and 
+    attaches the token to the entry, all in one multirequest. Kaltura 
+    accepts a token whose file hasn't been uploaded yet, so the file can 
+    be sent afterwards. Returns the upload token id and the entry id.
+    '''
+    batch = kaltura_client.multiRequest()
+    resource = KalturaUploadedFileTokenResource()
+    if uploadTokenId is None:
+        resource.token = batch.ref(batch.add('uploadToken', 'add', {'uploadToken': {}}))
+    else:
+        resource.token = uploadTokenId
+    entry = batch.add('media', 'add', {'entry': mediaEntry.toDict()})
+    batch.add('media', 'addContent', {'entryId': batch.ref(entry), 'resource': resource.toDict()})
+
+    results = batch.send()
+    if uploadTokenId is None:
+        uploadTokenId = results[0]['id']
+    return uploadTokenId, results[entry - 1]['id']
 
-    ## Step 2: Upload the file using the upload token we just obtained.
-    uploadTokenId = token.id
-    fileData = open(rec.filepath, 'rb')
-    resume = False
-    finalChunk = True
-    resumeAt = 0
-    result = kaltura_client.uploadToken.upload(uploadTokenId, fileData, resume, finalChunk, resumeAt)
+def upload_video (rec: LectureRecording, course: Course, kaltura_client: KalturaClient, kaltura_name, instructorIndex: int = -1, chunk_size: int = 0) -> tuple[str, str]:
+    '''
+    Uploads a recording and creates its media entry, returning the 
+    upload token id and the id of the new entry. The entry is owned by 
+    the host at instructorIndex (the first alphabetically by default) and
+    the course's other hosts are made co-editors and co-publishers, so a
+    team-taught course only needs one upload.
 
-    ## Step 3: Create a media entry. This is the actual database record.
+    This takes two round trips to Kaltura: one multirequest to create the 
+    token and entry, and the upload itself (one request per chunk when 
+    uploading in chunks). The token and entry ids are saved next to the 
+    recording until the upload finishes, so a failed upload is retried 
+    with the same entry rather than leaving an empty one behind.
+    '''
     mediaEntry = KalturaMediaEntry()
     mediaEntry.name = kaltura_name
     mediaEntry.description = f'Class recording for {course.number} {course.name} on {rec.date.strftime("%d-%m-%Y")}'
@@ -62,11 +228,32 @@ def upload_video (rec: LectureRecording, course: Course, kaltura_client: Kaltura
         mediaEntry.userId = course.get_first_host_alphabetically().unid
     else:
         mediaEntry.userId = course.hosts[instructorIndex].unid
-    entry = kaltura_client.media.add(mediaEntry)
+    co_hosts = ','.join(host.unid for host in course.hosts if host.unid != mediaEntry.userId)
+    if co_hosts:
+        mediaEntry.entitledUsersEdit = co_hosts
+        mediaEntry.entitledUsersPublish = co_hosts
 
-    ## Step 4: Attach the video to the media entry using the upload token to refer to the video file.
-    entry_id = entry.id
-    resource = KalturaUploadedFileTokenResource()
-    resource.token = uploadTokenId
+    ## Step 1: Get an upload token and create the media entry with it in one request, unless an interrupted upload already did
+    stat = os.stat(rec.filepath)
+    state = load_upload_state(rec.filepath, stat.st_size, stat.st_mtime_ns)
+    if state is not None and state.get('entryId'):
+        uploadTokenId, entry_id = state['uploadTokenId'], state['entryId']
+    else:
+        uploadTokenId, entry_id = create_media_entry(kaltura_client, mediaEntry, state['uploadTokenId'] if state else None)
+        state = state or {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'offset': 0}
+        save_upload_state(rec.filepath, {**state, 'uploadTokenId': uploadTokenId, 'entryId': entry_id})
+
+    if chunk_size > 0:
+        ## Step 2: Upload the file in chunks which can be resumed if the upload is interrupted
+        upload_file_in_chunks(kaltura_client, rec.filepath, chunk_size)
+    else:
+        ## Step 2: Upload the file using the upload token. If this fails the saved state 
+        ## lets the next attempt send the file again to the same token and entry
+        resume = False
+        finalChunk = True
+        resumeAt = 0
+        with open(rec.filepath, 'rb') as fileData:
+            result = kaltura_client.uploadToken.upload(uploadTokenId, fileData, resume, finalChunk, resumeAt)
+        os.remove(get_upload_state_path(rec.filepath))
 
-    result = kaltura_client.media.addContent(entry_id, resource)
+    return uploadTokenId, entry_id
@@ -0,0 +1,167 @@
+'''
+Load test for Upload mode. Starts the local Kaltura stand-in, fills a watch
+folder with synthetic recordings of scheduled classes and runs
+process_existing_files over them, then reports throughput, per-file upload
+latency and how many requests had to be retried. Run from the repo root
+(it needs config.ini, like the rest of the app):
+
+    python load_test.py --files 2000 --workers 8 --latency 0.05 --error-rate 0.02 --expire-rate 0.001
+'''
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+from datetime import timedelta
+from threading import Lock
+from time import perf_counter
+from unittest import mock
+from data_types import *
+from benchmark import generate_schedule
+from format_parser import format_recording_filename
+from kaltura_standin import KalturaStandIn
+from kaltura_uploader import KalturaSessionManager
+from mock_kaltura_client import KalturaConfiguration
+import video_sorter
+
+class UploadTimer:
+    '''
+    Wraps upload_video and records how long each upload took, retries and all
+    '''
+    def __init__(self, upload_video):
+        self.upload_video = upload_video
+        self.lock = Lock()
+        self.seconds: list[float] = []
+        self.failed = 0
+
+    def __call__(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            result = self.upload_video(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        with self.lock:
+            self.seconds.append(perf_counter() - start)
+        return result
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+    The nearest-rank pth percentile of values, or 0 if there are none
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def generate_watch_folder(courses: list[Course], count: int, folder: str, size: int, seed: int = 0):
+    '''
+    Writes count recordings of size bytes to the folder, each of a course
+    on one of the last four weeks' days it met, starting on time
+    '''
+    rng = random.Random(seed)
+    scheduled = [course for course in courses if course.days and course.start_time is not None]
+    data = rng.randbytes(size)
+    today = date.today()
+    names = set()
+    while len(names) < count:
+        course = rng.choice(scheduled)
+        rec_date = today - timedelta(days=rng.randint(1, 28))
+        if rec_date.strftime('%A') not in course.days:
+            continue
+        name = format_recording_filename(LectureRecording(None, rec_date, course.start_time, course.room_number, 'extron'))
+        if name in names:
+            continue
+        names.add(name)
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+
+def run_load_test(files: int = 2000, sections: int = 2000, size: int = 64 * 1024, workers: int = 8, chunk_size: int = 0,
+                  latency: float = 0.02, bandwidth: float = 0, error_rate: float = 0, error_status: int = 503,
+                  expire_rate: float = 0, retries: int = 3, backoff: float = 0.1, seed: int = 0) -> dict:
+    '''
+    Sorts files synthetic recordings in Upload mode against a stand-in
+    with the given latency (seconds), bandwidth (bytes/s) and share of
+    failed and expired requests, and returns what it measured
+    '''
+    server = KalturaStandIn(latency=latency, bandwidth=bandwidth, error_rate=error_rate, expire_rate=expire_rate, keep_uploads=False, seed=seed)
+    server.fail_status = error_status
+    server.start()
+    config = KalturaConfiguration(poolSize=max(10, workers), retries=retries, backoffFactor=backoff, serviceUrl=server.service_url)
+    session = KalturaSessionManager(config)
+    timer = UploadTimer(video_sorter.upload_video)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            watch = os.path.join(folder, 'ToSort')
+            dest = os.path.join(folder, 'Sorted')
+            os.makedirs(watch)
+            os.makedirs(dest)
+            courses = video_sorter.parse_courses(generate_schedule(sections, seed))
+            generate_watch_folder(courses, files, watch, size, seed)
+
+            environ = {'PARTNER_ID': server.partner_id, 'TOKEN': 'token', 'TOKEN_ID': 'token_id'}
+            with mock.patch.dict(os.environ, environ), mock.patch.multiple(video_sorter, KALTURA_SESSION=session, UPLOAD_WORKERS=workers,
+                                                                           UPLOAD_CHUNK_SIZE=chunk_size, LOG_UPLOAD_TIMINGS=False, upload_video=timer):
+                start = perf_counter()
+                video_sorter.process_existing_files(courses, watch, dest, 'Upload')
+                elapsed = perf_counter() - start
+            left = sum(1 for name in os.listdir(watch) if name.endswith('.mp4'))
+    finally:
+        server.stop()
+
+    uploaded = len(timer.seconds)
+    return {
+        'files': files,
+        'uploaded': uploaded,
+        'upload_failures': timer.failed,
+        'left_in_watch_folder': left,
+        'seconds': elapsed,
+        'files_per_second': files / max(elapsed, 1e-6),
+        'upload_mb_per_second': uploaded * size / 1_000_000 / max(elapsed, 1e-6),
+        'latency_p50': percentile(timer.seconds, 50),
+        'latency_p95': percentile(timer.seconds, 95),
+        'latency_max': max(timer.seconds, default=0.0),
+        'client_retries': session.client.retryCount if session.client else 0,
+        'injected_errors': server.injected_errors,
+        'injected_expiries': server.injected_expiries,
+        'sessions_started': len(server.calls_to('apptoken.startSession')),
+        'http_requests': server.requests,
+        'connections': server.connections,
+    }
+
+def print_report(report: dict):
+    print(f'Upload load test over {report["files"]} files')
+    print(f'  uploaded:           {report["uploaded"]} ({report["upload_failures"]} failed, {report["left_in_watch_folder"]} left in the watch folder)')
+    print(f'  elapsed:            {report["seconds"]:8.2f}s')
+    print(f'  throughput:         {report["files_per_second"]:8.1f} files/s, {report["upload_mb_per_second"]:.2f} MB/s')
+    print(f'  upload latency:     p50 {report["latency_p50"] * 1000:.0f} ms, p95 {report["latency_p95"] * 1000:.0f} ms, max {report["latency_max"] * 1000:.0f} ms')
+    print(f'  client retries:     {report["client_retries"]} ({report["injected_errors"]} injected errors, {report["injected_expiries"]} expired sessions)')
+    print(f'  sessions started:   {report["sessions_started"]}')
+    print(f'  HTTP requests:      {report["http_requests"]} over {report["connections"]} connection(s)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test Upload mode against a local Kaltura stand-in')
+    parser.add_argument('--files', type=int, default=2000, help='Synthetic recordings to sort')
+    parser.add_argument('--sections', type=int, default=2000, help='Sections in the synthetic schedule')
+    parser.add_argument('--size-kb', type=int, default=64, help='Size of each recording')
+    parser.add_argument('--workers', type=int, default=8, help='Upload workers')
+    parser.add_argument('--chunk-size-kb', type=int, default=0, help='Upload in chunks of this size, or 0 for one request per file')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stand-in adds to every request')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='Megabits per second each connection can upload at, or 0 for no cap')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests answered with --error-status')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--expire-rate', type=float, default=0, help='Share of requests whose session is expired first')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=0.1, help='Backoff factor for retries, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    print_report(run_load_test(
+        files=args.files, sections=args.sections, size=args.size_kb * 1024, workers=args.workers, chunk_size=args.chunk_size_kb * 1024,
+        latency=args.latency, bandwidth=args.bandwidth_mbps * 1_000_000 / 8, error_rate=args.error_rate, error_status=args.error_status,
+        expire_rate=args.expire_rate, retries=args.retries, backoff=args.backoff, seed=args.seed,
+    ))
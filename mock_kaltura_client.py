@@ -6,17 +6,55 @@ take much to migrate scripts to use it.
 '''
 
 import requests
+from threading import Lock
+from urllib.parse import parse_qs, urlsplit
+from time import sleep
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SERVICE_URL = 'https://www.kaltura.com/api_v3/service'
 
 class KalturaConfiguration:
-    pass
+    '''
+    Connection settings for a KalturaClient. poolSize is how many 
+    connections are kept open for reuse, which should be at least the 
+    number of threads sharing the client. Requests that couldn't connect
+    are retried up to `retries` times with exponential backoff, as are 
+    502, 503 and 504 answers to calls that are safe to repeat (see 
+    KalturaClient.post).
+    serviceUrl is where the API is served from, kaltura.com unless set
+    (e.g. to a local stand-in for testing).
+    '''
+    def __init__(self, poolSize=10, connectTimeout=10, readTimeout=300, retries=3, backoffFactor=1, serviceUrl=None):
+        self.poolSize = poolSize
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.backoffFactor = backoffFactor
+        self.serviceUrl = serviceUrl
+
+class KalturaException(Exception):
+    '''
+    An error returned by the Kaltura API, such as an expired session
+    '''
+    def __init__(self, code, message):
+        super().__init__(f'{code}: {message}')
+        self.code = code
+
+# Error codes meaning the session (KS) has to be started again
+SESSION_EXPIRED_CODES = ('EXPIRED_KS', 'INVALID_KS')
+
+# Answers that a call which is safe to repeat is retried after
+RETRY_STATUSES = (502, 503, 504)
 
 class KalturaUploadToken:
-    def __init__(self, id=None):
+    def __init__(self, id=None, uploadedFileSize=None):
         self.id = id
+        self.uploadedFileSize = uploadedFileSize
 
     @staticmethod
     def fromJsonResponse(res):
-        return KalturaUploadToken(id=res['id'])
+        return KalturaUploadToken(id=res['id'], uploadedFileSize=res.get('uploadedFileSize', None))
 
 class KalturaServiceBase:
     def __init__(self, client):
@@ -28,6 +66,10 @@ class KalturaMediaEntry:
         self.description = None
         self.mediaType = None
         self.id = None
+        self.userId = None
+        # Comma separated user ids who can edit/publish the entry as well as its owner
+        self.entitledUsersEdit = None
+        self.entitledUsersPublish = None
 
     @staticmethod
     def fromJsonResponse(res):
@@ -36,6 +78,9 @@ class KalturaMediaEntry:
         mediaEntry.description = res['description']
         mediaEntry.mediaType = res['mediaType']
         mediaEntry.id = res['id']
+        mediaEntry.userId = res.get('userId')
+        mediaEntry.entitledUsersEdit = res.get('entitledUsersEdit')
+        mediaEntry.entitledUsersPublish = res.get('entitledUsersPublish')
         return mediaEntry
 
     def toDict (self):
@@ -46,6 +91,10 @@ class KalturaMediaEntry:
         }
         if self.userId:
             result['userId'] = self.userId
+        if self.entitledUsersEdit:
+            result['entitledUsersEdit'] = self.entitledUsersEdit
+        if self.entitledUsersPublish:
+            result['entitledUsersPublish'] = self.entitledUsersPublish
         return result
     
 class KalturaUploadedFileTokenResource:
@@ -76,47 +125,170 @@ class KalturaUser:
         user.id = res['id']
         return user
 
-class KalturaClient:
+class KalturaMultiRequest:
+    '''
+    Several API calls sent to the multirequest endpoint in one HTTP round 
+    trip. A call can use a field of an earlier call's result through 
+    ref(), which the server fills in before running it:
+
+        batch = client.multiRequest()
+        token = batch.add('uploadToken', 'add', {'uploadToken': {}})
+        batch.add('media', 'addContent', {'entryId': entryId, 'resource': {'token': batch.ref(token)}})
+        tokenResult, _ = batch.send()
+    '''
+    def __init__(self, client):
+        self.client: KalturaClient = client
+        self.calls: list[dict] = []
+
+    def add(self, service: str, action: str, params: dict | None = None) -> int:
+        '''
+        Queues a call and returns its (1 based) position, for use with ref()
+        '''
+        self.calls.append({'service': service, 'action': action, **(params or {})})
+        return len(self.calls)
+
     @staticmethod
-    def kurl (path, **kwargs):
+    def ref(index: int, field: str = 'id') -> str:
+        return f'{{{index}:result:{field}}}'
+
+    def send(self) -> list[dict]:
+        '''
+        Sends the queued calls and returns their results in order. The 
+        first call that failed is raised as a KalturaException.
+        '''
+        calls = {str(i): call for i, call in enumerate(self.calls, start=1)}
+        res = self.client.post(self.client.kurl('multirequest'), json=self.client.getRequestData(calls))
+        res.raise_for_status()
+        results = res.json()
+        for result in results:
+            if isinstance(result, dict) and result.get('objectType') == 'KalturaAPIException':
+                raise KalturaException(result.get('code'), result.get('message'))
+        return results
+
+class KalturaClient:
+    def kurl (self, path, **kwargs):
         query = '?format=1'
         for key, value in kwargs.items():
             query += f'&{key}={value}'
-        url = f'https://www.kaltura.com/api_v3/service/{path}{query}'
+        url = f'{self.config.serviceUrl or SERVICE_URL}/{path}{query}'
         return url
     
-    def getRequestData(self, data={}) -> dict:
+    def post(self, url, idempotent=False, renewSession=True, **kwargs) -> requests.Response:
+        '''
+        Sends a request over the client's pooled connections. Safe to 
+        call from several threads at once.
+
+        Errors returned by the API are raised as KalturaExceptions, and 
+        other failed requests as requests.HTTPError. If the session has 
+        expired and onSessionExpired is set, it is called with the KS the 
+        request was sent with, and the request is sent once more with the 
+        client's current KS. Calls that start a session pass 
+        renewSession=False, since they're made while renewing.
+
+        Only idempotent calls are sent again after a 502, 503 or 504. Any 
+        other call (e.g. adding an entry or uploading a chunk) may already 
+        have been carried out by Kaltura, so repeating it could add a second 
+        entry, and the error is raised instead.
+        '''
+        res = self._send(url, idempotent, **kwargs)
+        error = self._getError(res)
+        # Another thread may have renewed the session since this request was 
+        # built, so it's the request's own KS that has expired
+        ks = self._getRequestKs(url, kwargs)
+        if error is not None and error.code in SESSION_EXPIRED_CODES and ks and renewSession and self.onSessionExpired:
+            self.onSessionExpired(ks)
+            self._countRetries(1)
+            url, kwargs = self._withSession(url, kwargs, ks, self.sessionData.ks)
+            res = self._send(url, idempotent, **kwargs)
+            error = self._getError(res)
+        if error is not None:
+            raise error
+        res.raise_for_status()
+        return res
+
+    def _send(self, url, idempotent=False, **kwargs) -> requests.Response:
+        attempt = 0
+        while True:
+            # A file being uploaded has to be rewound before it can be sent again
+            for fileData in kwargs.get('files', {}).values():
+                if hasattr(fileData, 'seek'):
+                    fileData.seek(0)
+            res = self.httpSession.post(url, timeout=(self.config.connectTimeout, self.config.readTimeout), **kwargs)
+            # urllib3 keeps the history of any connection retries on the response
+            retries = getattr(res.raw, 'retries', None)
+            if retries is not None and retries.history:
+                self._countRetries(len(retries.history))
+
+            if not idempotent or res.status_code not in RETRY_STATUSES or attempt >= self.config.retries:
+                return res
+            sleep(self.config.backoffFactor * 2 ** attempt)
+            attempt += 1
+            self._countRetries(1)
+
+    def _countRetries(self, count: int):
+        with self.retryLock:
+            self.retryCount += count
+
+    @staticmethod
+    def _getError(res: requests.Response) -> KalturaException | None:
+        try:
+            body = res.json()
+        except ValueError:
+            return None
+        if isinstance(body, dict) and body.get('objectType') == 'KalturaAPIException':
+            return KalturaException(body.get('code'), body.get('message'))
+        return None
+
+    @staticmethod
+    def _getRequestKs(url, kwargs) -> str | None:
+        ks = (kwargs.get('json') or {}).get('ks')
+        if ks is None:
+            ks = parse_qs(urlsplit(url).query).get('ks', [None])[0]
+        return ks
+
+    @staticmethod
+    def _withSession(url, kwargs, oldKs, newKs):
+        url = url.replace(f'ks={oldKs}', f'ks={newKs}')
+        if kwargs.get('json', {}).get('ks') == oldKs:
+            kwargs = {**kwargs, 'json': {**kwargs['json'], 'ks': newKs}}
+        return url, kwargs
+
+    def multiRequest(self) -> KalturaMultiRequest:
+        return KalturaMultiRequest(self)
+
+    def getRequestData(self, data={}, session=None) -> dict:
+            session = session or self.sessionData
             return {
-                'ks': self.sessionData.ks,
-                'partnerId': self.sessionData.partnerId,
+                'ks': session.ks,
+                'partnerId': session.partnerId,
                 **data
             }
     
+    # Starting a session returns it without setting it on the client, like 
+    # the real SDK, so a session can be started while others are in use
     class SessionService(KalturaServiceBase):
         def startWidgetSession(self, widgetId: str, expiry: int):
-            res = requests.post(KalturaClient.kurl('session/action/startWidgetSession'), json={
+            res = self.client.post(self.client.kurl('session/action/startWidgetSession'), idempotent=True, renewSession=False, json={
                 'expiry': expiry,
                 'widgetId': widgetId
             }).json()
-            self.client.sessionData = KalturaClient.SessionData(res)
-            return self.client.sessionData
+            return KalturaClient.SessionData(res)
 
     class AppTokenService(KalturaServiceBase):
-        def startSession (self, id, tokenHash):
-            res = requests.post(KalturaClient.kurl('apptoken/action/startSession'), json=self.client.getRequestData({
+        def startSession (self, id, tokenHash, session=None):
+            res = self.client.post(self.client.kurl('apptoken/action/startSession'), idempotent=True, renewSession=False, json=self.client.getRequestData({
                 'id': id,
                 'tokenHash': tokenHash
-            })).json()
-            self.client.sessionData = KalturaClient.SessionData(res)
-            return self.client.sessionData
+            }, session)).json()
+            return KalturaClient.SessionData(res)
         
     class UploadTokenService(KalturaServiceBase):
         def add (self, uploadToken):
-            res = requests.post(KalturaClient.kurl('uploadtoken/action/add'), json=self.client.getRequestData()).json()
+            res = self.client.post(self.client.kurl('uploadtoken/action/add'), json=self.client.getRequestData()).json()
             return KalturaUploadToken(id=res['id'])
         
         def upload (self, uploadTokenId, fileData, resume, finalChunk, resumeAt):
-            url = KalturaClient.kurl(
+            url = self.client.kurl(
                 'uploadtoken/action/upload', 
                 uploadTokenId=uploadTokenId, 
                 resume='true' if resume else 'false',
@@ -125,20 +297,27 @@ class KalturaClient:
                 ks=self.client.sessionData.ks,
                 partnerId=self.client.sessionData.partnerId
             )
-            res = requests.post(url, files={
+            res = self.client.post(url, files={
                 'fileData': fileData
-            }).json()
-            return {}
+            })
+            res.raise_for_status()
+            return KalturaUploadToken.fromJsonResponse(res.json())
+
+        def get (self, uploadTokenId):
+            res = self.client.post(self.client.kurl('uploadtoken/action/get'), idempotent=True, json=self.client.getRequestData({
+                'uploadTokenId': uploadTokenId
+            })).json()
+            return KalturaUploadToken.fromJsonResponse(res)
         
     class MediaService(KalturaServiceBase):
         def add (self, mediaEntry: KalturaMediaEntry):
-            res = requests.post(KalturaClient.kurl('media/action/add'), json=self.client.getRequestData({
+            res = self.client.post(self.client.kurl('media/action/add'), json=self.client.getRequestData({
                 'entry': mediaEntry.toDict()
             })).json()
             return KalturaMediaEntry.fromJsonResponse(res)
         
         def addContent(self, entry_id, resource):
-            res = requests.post(KalturaClient.kurl('media/action/addContent'), json=self.client.getRequestData({
+            res = self.client.post(self.client.kurl('media/action/addContent'), json=self.client.getRequestData({
                 'entryId': entry_id,
                 'resource': resource.toDict()
             })).json()
@@ -146,13 +325,13 @@ class KalturaClient:
         
     class UserService(KalturaServiceBase):
         def getByLoginId(self, loginId) -> KalturaUser:
-            res = requests.post(KalturaClient.kurl('user/action/getByLoginId'), json=self.client.getRequestData({
+            res = self.client.post(self.client.kurl('user/action/getByLoginId'), idempotent=True, json=self.client.getRequestData({
                 'loginId': loginId
             })).json()
             return KalturaUser.fromJsonResponse(res)
         
         def get(self, userId) -> KalturaUser:
-            res = requests.post(KalturaClient.kurl('user/action/get'), json=self.client.getRequestData({
+            res = self.client.post(self.client.kurl('user/action/get'), idempotent=True, json=self.client.getRequestData({
                 'userId': userId
             })).json()
             return KalturaUser.fromJsonResponse(res)
@@ -162,6 +341,7 @@ class KalturaClient:
                 self.ks = jsonResponse['ks']
                 self.partnerId = jsonResponse['partnerId']
                 self.userId = jsonResponse.get('userId', None)
+                self.expiry = jsonResponse.get('expiry', None)
 
     def __init__(self, config):
          self.session = self.SessionService(self)
@@ -170,4 +350,27 @@ class KalturaClient:
          self.media = self.MediaService(self)
          self.user = self.UserService(self)
          self.config = config
-         self.sessionData = None
\ No newline at end of file
+         self.sessionData = None
+         self.onSessionExpired = None
+         # Requests sent again, after a 5xx or with a renewed session
+         self.retryCount = 0
+         self.retryLock = Lock()
+
+         # One pool of keep-alive connections shared by every service, so each 
+         # API call doesn't pay for a new TCP and TLS handshake
+         # Only connections that failed before the request was sent are 
+         # retried here; 5xx answers are retried by _send, for idempotent calls
+         retry = Retry(
+             total=config.retries,
+             connect=config.retries,
+             read=0,
+             status=0,
+             other=0,
+             backoff_factor=config.backoffFactor,
+             allowed_methods=None,
+             raise_on_status=False,
+         )
+         adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.poolSize, max_retries=retry)
+         self.httpSession = requests.Session()
+         self.httpSession.mount('https://', adapter)
+         self.httpSession.mount('http://', adapter)
\ No newline at end of file
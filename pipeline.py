@@ -0,0 +1,145 @@
+'''
+A small staged pipeline. Each stage runs on its own worker threads and
+hands items to the next stage through a bounded queue, so a slow stage
+(e.g. uploading) holds back the cheap stages ahead of it instead of
+letting work pile up in memory.
+
+    pipeline = Pipeline(paths, [Stage('parse', parse), Stage('upload', upload, workers=4)], queue_size=8)
+    pipeline.run()
+    pipeline.log_stats()
+
+A stage's work function takes one item and returns the item for the next
+stage, or None to drop it (e.g. because it was dealt with already).
+A stage's on_done, if given, is called once its last worker finishes.
+'''
+
+from queue import Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable
+import logging
+
+# Put on a stage's queue once per worker when there is nothing left for it
+DONE = object()
+
+class Stage:
+    '''
+    One step of the pipeline and the counts of what it did
+    '''
+    def __init__(self, name: str, work: Callable[[Any], Any], workers: int = 1, on_done: Callable[[], None] | None = None):
+        self.name = name
+        self.work = work
+        self.on_done = on_done
+        self.workers = max(1, workers)
+        self.lock = Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._running = 0
+
+    def _record(self, seconds: float, result, failed: bool, depth: int):
+        with self.lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+            if failed:
+                self.failed += 1
+            elif result is None:
+                self.dropped += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self._depth_total += depth
+            self._depth_samples += 1
+
+    def summary(self, elapsed: float) -> str:
+        average_depth = self._depth_total / self._depth_samples if self._depth_samples else 0
+        return (f'{self.name}: {self.processed} item(s) in {self.busy_seconds:.2f}s busy on {self.workers} worker(s), '
+                f'{self.processed / max(elapsed, 1e-6):.1f}/s, {self.dropped} dropped, {self.failed} failed, '
+                f'queue depth avg {average_depth:.1f} max {self.max_queue_depth}')
+
+class Pipeline:
+    '''
+    Feeds items from the source through the stages in order. No more than
+    queue_size items wait in front of any one stage.
+    '''
+    def __init__(self, source: Iterable, stages: list[Stage], queue_size: int = 8, source_name: str = 'scan'):
+        self.source = source
+        self.source_name = source_name
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.scanned = 0
+        self.scan_seconds = 0.0
+        self.elapsed = 0.0
+
+    def run(self):
+        '''
+        Runs every item through the pipeline, returning once the last stage is done
+        '''
+        start = perf_counter()
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            stage._running = stage.workers
+            next_queue = queues[i + 1] if i + 1 < len(self.stages) else None
+            next_stage = self.stages[i + 1] if next_queue is not None else None
+            for n in range(stage.workers):
+                thread = Thread(target=self._work, args=(stage, queues[i], next_stage, next_queue), name=f'{stage.name}-{n}', daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+            iterator = iter(self.source)
+            while True:
+                scan_start = perf_counter()
+                item = next(iterator, DONE)
+                self.scan_seconds += perf_counter() - scan_start
+                if item is DONE:
+                    break
+                self.scanned += 1
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(DONE)
+            for thread in threads:
+                thread.join()
+            self.elapsed = perf_counter() - start
+
+    def _work(self, stage: Stage, queue: Queue, next_stage: Stage | None, next_queue: Queue | None):
+        while True:
+            depth = queue.qsize()
+            item = queue.get()
+            if item is DONE:
+                break
+
+            work_start = perf_counter()
+            failed = False
+            try:
+                result = stage.work(item)
+            except Exception as e:
+                logging.error(f'Error in the {stage.name} stage for {item}: {e}')
+                result = None
+                failed = True
+            stage._record(perf_counter() - work_start, result, failed, depth)
+            if result is not None and next_queue is not None:
+                next_queue.put(result)
+
+        # The last worker out tells the next stage there is nothing more coming
+        with stage.lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last and stage.on_done is not None:
+            try:
+                stage.on_done()
+            except Exception as e:
+                logging.error(f'Error finishing the {stage.name} stage: {e}')
+        if last and next_queue is not None:
+            for _ in range(next_stage.workers):
+                next_queue.put(DONE)
+
+    def log_stats(self):
+        logging.info(f'Pipeline finished {self.scanned} item(s) in {self.elapsed:.2f}s with at most {self.queue_size} queued per stage')
+        logging.info(f'  {self.source_name}: {self.scanned} item(s) in {self.scan_seconds:.2f}s, {self.scanned / max(self.elapsed, 1e-6):.1f}/s')
+        for stage in self.stages:
+            logging.info(f'  {stage.summary(self.elapsed)}')
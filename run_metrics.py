@@ -0,0 +1,190 @@
+'''
+Timings and counts from the sorter's runs, written out after each run so
+throughput can be graphed and slow shares or slow Kaltura days stand out.
+The results go to a file for the Prometheus node_exporter textfile 
+collector and to a JSON summary. Counts and times add up over every run 
+since the sorter started, so batches written in quick succession don't 
+overwrite each other, and Prometheus' rate() and increase() work on them:
+
+    metrics = RunMetrics()
+    metrics.start_run()
+    with metrics.timed('move_video'):
+        result = move_file(src, dest)
+    metrics.add_bytes('moved', result.size)
+    metrics.count_match('extron', matched=True)
+    metrics.finish_run()
+    metrics.write_prometheus('/var/lib/node_exporter/textfile_collector/video_sorter.prom')
+    metrics.write_json('metrics.json')
+'''
+
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from time import perf_counter
+import json
+import os
+
+METRIC_PREFIX = 'video_sorter'
+
+class OperationStats:
+    '''
+    How often an operation ran, how long it took and how often it failed
+    '''
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'average_seconds': self.seconds / self.count if self.count else 0.0,
+        }
+
+class RunMetrics:
+    '''
+    Collects the metrics of every run since it was created, and when the 
+    last run started and how long it took. Safe to update from the 
+    pipeline's worker threads.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets everything recorded so far
+        '''
+        with self.lock:
+            self.since = datetime.now()
+            self.started = self.since
+            self._start = perf_counter()
+            self.last_duration = 0.0
+            self.runs = 0
+            self.operations: dict[str, OperationStats] = {}
+            # e.g. 'moved', 'uploaded', 'reaped' -> bytes
+            self.bytes: dict[str, int] = {}
+            # (device, 'hit' or 'miss') -> recordings
+            self.matches: dict[tuple[str, str], int] = {}
+            self.counters: dict[str, int] = {}
+
+    def start_run(self):
+        '''
+        Marks the start of a pass, so the run's duration doesn't include 
+        the time spent waiting for it
+        '''
+        with self.lock:
+            self.started = datetime.now()
+            self._start = perf_counter()
+
+    def finish_run(self):
+        with self.lock:
+            self.last_duration = perf_counter() - self._start
+            self.runs += 1
+
+    def observe(self, operation: str, seconds: float, error: bool = False):
+        with self.lock:
+            stats = self.operations.setdefault(operation, OperationStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if error:
+                stats.errors += 1
+
+    @contextmanager
+    def timed(self, operation: str):
+        '''
+        Times the block as one run of the operation, counting it as an error if it raises
+        '''
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(operation, perf_counter() - start, error=True)
+            raise
+        self.observe(operation, perf_counter() - start)
+
+    def add_bytes(self, kind: str, size: int):
+        with self.lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_match(self, device: str | None, matched: bool):
+        key = (device or 'unknown', 'hit' if matched else 'miss')
+        with self.lock:
+            self.matches[key] = self.matches.get(key, 0) + 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            devices: dict[str, dict[str, int]] = {}
+            for (device, result), count in sorted(self.matches.items()):
+                devices.setdefault(device, {'hit': 0, 'miss': 0})[result] = count
+            return {
+                'since': self.since.isoformat(timespec='seconds'),
+                'runs': self.runs,
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': self.last_duration,
+                'operations': {name: stats.to_dict() for name, stats in sorted(self.operations.items())},
+                'bytes': dict(sorted(self.bytes.items())),
+                'matches': devices,
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus_text(self) -> str:
+        '''
+        The metrics in the Prometheus text exposition format. Everything 
+        but the last run's start and duration is a running total.
+        '''
+        summary = self.summary()
+        lines: list[str] = []
+
+        def family(name: str, kind: str, help: str, samples: list[tuple[str, dict[str, str], float]]):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f'{METRIC_PREFIX}_{name}{suffix}{{{label_text}}} {value}' if label_text else f'{METRIC_PREFIX}_{name}{suffix} {value}')
+
+        family('run_start_timestamp_seconds', 'gauge', 'When the last run started', [('', {}, self.started.timestamp())])
+        family('run_duration_seconds', 'gauge', 'How long the last run took', [('', {}, summary['seconds'])])
+        family('runs_total', 'counter', 'Runs finished since the sorter started', [('', {}, summary['runs'])])
+        operations = summary['operations'].items()
+        family('operation_duration_seconds', 'summary', 'Time spent in each operation',
+               [sample for name, stats in operations for sample in (('_sum', {'operation': name}, stats['seconds']), ('_count', {'operation': name}, stats['count']))])
+        family('operation_duration_seconds_max', 'gauge', 'Longest single run of each operation since the sorter started',
+               [('', {'operation': name}, stats['max_seconds']) for name, stats in operations])
+        family('operation_errors_total', 'counter', 'Failed runs of each operation',
+               [('', {'operation': name}, stats['errors']) for name, stats in operations])
+        family('bytes_total', 'counter', 'Bytes moved, uploaded and reaped',
+               [('', {'kind': kind}, size) for kind, size in summary['bytes'].items()])
+        family('recordings_matched_total', 'counter', 'Recordings that did (hit) or did not (miss) match a course, by device',
+               [('', {'device': device, 'result': result}, count) for device, results in summary['matches'].items() for result, count in results.items()])
+        for name, value in summary['counters'].items():
+            family(f'{name}_total', 'counter', f'{name.replace("_", " ").capitalize()}', [('', {}, value)])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        write_atomically(path, self.prometheus_text())
+
+    def write_json(self, path: str):
+        write_atomically(path, json.dumps(self.summary(), indent=2))
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_atomically(path: str, text: str):
+    '''
+    Writes the file next to its final path and renames it into place, so
+    the textfile collector never reads a half written file
+    '''
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -1,11 +1,35 @@
 import os
 import configparser
+import json
+import pandas as pd
+import pytest
+import requests
+import shutil
+from threading import Lock, Thread
+from time import monotonic, sleep
+from datetime import timedelta
 config = configparser.ConfigParser()
 config.read('config.ini')
 
 from data_types import *
-from video_sorter import read_courses, match_courses_to_recordings, move_video, get_new_filepath, process_existing_files
-from file_reaper import reap_files
+import video_sorter
+from video_sorter import CourseSchedule, iter_matched_recordings, parse_courses, read_courses, match_courses_to_recordings, move_video, get_new_filepath, process_existing_files
+from file_reaper import get_semester_range, reap_files, reap_files_parallel, reap_indexed_files, ReapStats, RetentionIndex
+from format_parser import format_recording_filename, parse_recording_filename
+from course_index import CourseIndex, get_course_index
+from folder_watcher import RecordingWatcher
+from pipeline import Pipeline, Stage
+from dedup import DuplicateDetector
+import dedup
+import job_journal
+import file_mover
+import load_test
+from course_cache import get_cache_path
+from job_journal import *
+from kaltura_standin import KalturaStandIn
+from kaltura_uploader import KalturaSessionManager, get_kaltura_client, upload_video, upload_file_in_chunks, get_upload_state_path
+from mock_kaltura_client import KalturaClient, KalturaConfiguration, KalturaUploadToken
+import mock_kaltura_client
 
 def clear_directory(directory_path):
     try:
@@ -48,19 +72,8 @@ def generate_files (recs: list[LectureRecording], numBytes=4):
     os.makedirs(destination_path, exist_ok=True)
 
     for rec in recs:
-        filename = ''
-
-        if rec.rec_device == 'extron':
-            stringdate = rec.date.strftime("%Y%m%d")
-            stringtime = rec.time.strftime("%H%M%S")
-            filename = f'{rec.room_number}_{stringdate}-1_{stringdate}-{stringtime}_S1R1.mp4'
-        elif rec.rec_device == 'extron_2100':
-            stringdate = rec.date.strftime("%Y%m%d")
-            stringtime = rec.time.strftime("%H%M%S")
-            filename = f'SMP-2100_{stringdate}-{stringtime}_S1R1.mp4'
-        elif rec.rec_device == 'capturecast':
-            filename = f'{rec.course_code}-{rec.course_number}-{rec.section_number}---{rec.date.month}-{rec.date.day}-{rec.date.year}.mp4'
-        else:
+        filename = format_recording_filename(rec)
+        if filename is None:
             return
 
         filepath = os.path.join(watch_path, filename)
@@ -73,7 +86,10 @@ def generate_files (recs: list[LectureRecording], numBytes=4):
     return (watch_path, destination_path)
 
 def read_test_courses ():
-    return read_courses(os.path.join(os.path.curdir, 'test_courses.xlsx'))
+    return read_courses(os.path.join(os.path.curdir, 'test_courses.xlsx'), use_cache=False)
+
+def read_test_df ():
+    return pd.read_excel(os.path.join(os.path.curdir, 'test_courses.xlsx'))
 
 def get_test_recs ():
     return {
@@ -95,6 +111,52 @@ class TestSorter:
             for ins in course.hosts:
                 assert ins.last in lastnames[i]
 
+    def test_course_import_edge_cases (self):
+        df = read_test_df()
+        df.loc[0, 'Meeting Pattern'] = 'Sa 9am-12pm'
+        df.loc[1, 'Section #'] = float('nan')
+        df.loc[2, 'Meeting Pattern'] = 'ARR'
+        courses = parse_courses(df)
+        assert courses[0].days == {'Saturday'}
+        assert courses[0].start_time == time(9, 0)
+        assert courses[1].section_number == 'None'
+        assert courses[2].days == set()
+        assert courses[2].start_time is None
+        assert [h.unid for h in courses[2].hosts] == ['u0161189', 'u1344001']
+
+    def test_course_cache (self):
+        clear_test_folder()
+        excel_path = os.path.join(config.get('Paths', 'test_folder'), 'courses.xlsx')
+        shutil.copyfile(os.path.join(os.path.curdir, 'test_courses.xlsx'), excel_path)
+        courses = read_courses(excel_path)
+        assert os.path.exists(get_cache_path(excel_path))
+        cached = read_courses(excel_path)
+        assert [(c.number, c.name, c.days, c.start_time) for c in cached] == [(c.number, c.name, c.days, c.start_time) for c in courses]
+
+        df = read_test_df()
+        df.loc[0, 'Course Title'] = 'Renamed'
+        df.to_excel(excel_path, index=False)
+        assert read_courses(excel_path)[0].name == 'Renamed'
+
+    def test_schedule_reload (self):
+        clear_test_folder()
+        excel_path = os.path.join(config.get('Paths', 'test_folder'), 'courses.xlsx')
+        shutil.copyfile(os.path.join(os.path.curdir, 'test_courses.xlsx'), excel_path)
+        schedule = CourseSchedule(excel_path)
+        assert schedule.refresh()
+        first_index = schedule.index
+        assert not schedule.refresh()
+        os.utime(excel_path, (0, 0))
+        assert not schedule.refresh()
+        assert schedule.index is first_index
+
+        df = read_test_df()
+        df.loc[1, 'Course Title'] = 'Renamed'
+        df.to_excel(excel_path, index=False)
+        assert schedule.refresh()
+        assert schedule.index is not first_index
+        assert schedule.index.courses[1].name == 'Renamed'
+
     def test_valid_extron_sorting (self):
         courses = read_test_courses()
         testrec = get_test_recs()['extron']
@@ -131,6 +193,18 @@ class TestSorter:
         assert str(pairs[0][0]) == str(testrec)
         assert pairs[0][1].name == 'Course2'
 
+    def test_streamed_matching (self):
+        courses = read_test_courses()
+        recdict = get_test_recs()
+        clear_test_folder()
+        watch, destination = generate_files([recdict['extron'], recdict['capturecast']], numBytes=7)
+        os.mkdir(os.path.join(watch, 'folder.mp4'))
+        stream = iter_matched_recordings(courses, watch)
+        assert not isinstance(stream, list)
+        pairs = sorted(stream, key=lambda pair: pair[0].filename)
+        assert [pair[1].name for pair in pairs] == ['Course1: The Sequel', 'Course2']
+        assert all(pair[0].file_stat.st_size == 7 for pair in pairs)
+
     def test_get_user_alphabetical (self):
         courses = read_test_courses()
         for x in courses:
@@ -218,6 +292,23 @@ class TestSorter:
         assert os.path.exists(new_path)
         assert new_path == pairs[0][0].filepath
 
+    def test_class_folder_created_once (self, monkeypatch, caplog):
+        courses = read_test_courses()
+        clear_test_folder()
+        watch, destination = generate_files([])
+        rec = get_test_recs()['extron']
+        makedirs_calls = []
+        makedirs = os.makedirs
+        monkeypatch.setattr(os, 'makedirs', lambda *args, **kwargs: makedirs_calls.append(args) or makedirs(*args, **kwargs))
+        folder_cache = {}
+        with caplog.at_level('INFO'):
+            first = video_sorter.get_or_create_class_folder(courses[0], rec, destination, folder_cache)
+            assert video_sorter.get_or_create_class_folder(courses[0], rec, destination, folder_cache) == first
+            assert video_sorter.get_or_create_class_folder(courses[0], rec, destination) == first
+        assert os.path.isdir(first)
+        assert [args[0] for args in makedirs_calls].count(first) == 2
+        assert len([r for r in caplog.records if r.getMessage().startswith('Folder created')]) == 1
+
     def test_process_existing (self):
         courses = read_test_courses()
         recdict = get_test_recs()
@@ -237,6 +328,100 @@ class TestSorter:
         assert count_nondirectory_files(os.path.join(destination, 'Fall23')) == 3
         assert not os.path.exists(os.path.join(destination, 'Fall22'))
 
+    def test_duplicates_not_processed_twice (self):
+        courses = read_test_courses()
+        recdict = get_test_recs()
+        testrects = [recdict['extron'], recdict['extron_2100'], recdict['capturecast']]
+        clear_test_folder()
+        watch, destination = generate_files(testrects)
+        with open(recdict['capturecast'].filepath, 'wb') as f:
+            f.write(b'\x00' * 4)
+        journal = JobJournal(':memory:')
+        process_existing_files(courses, watch, destination, 'Move', from_date=datetime(2023, 4, 6), journal=journal, deduplicate=True)
+        assert count_nondirectory_files(watch) == 0
+        assert count_nondirectory_files(os.path.join(destination, 'Duplicates')) == 1
+        assert count_nondirectory_files(os.path.join(destination, 'Fall23')) == 2
+
+        # The duplicate's job can be found by where it came from
+        [duplicate] = os.listdir(os.path.join(destination, 'Duplicates'))
+        [(job, _)] = journal.history(os.path.join(watch, duplicate))
+        assert job.state == DUPLICATE
+        assert job.source_path == os.path.join(watch, duplicate)
+        assert job.dest_path == os.path.join(destination, 'Duplicates', duplicate)
+        journal.close()
+
+        # A later copy under the same name doesn't overwrite the first duplicate
+        duplicate = os.listdir(os.path.join(destination, 'Duplicates'))[0]
+        rec = recdict['extron_2100']
+        rec.filepath = os.path.join(watch, duplicate)
+        shutil.copy(os.path.join(destination, 'Duplicates', duplicate), rec.filepath)
+        assert video_sorter.move_duplicate_video(rec, recdict['extron'], destination)
+        assert sorted(os.listdir(os.path.join(destination, 'Duplicates'))) == [duplicate, duplicate.replace('.mp4', '_1.mp4')]
+
+    def test_duplicate_of_recording_being_moved (self):
+        recdict = get_test_recs()
+        clear_test_folder()
+        watch, destination = generate_files([recdict['extron'], recdict['extron_2100']])
+        original, copy = recdict['extron'], recdict['extron_2100']
+        detector = DuplicateDetector()
+        assert detector.find_original(original) is None
+
+        # The original is partway through its move: the file is gone but its path not yet updated
+        moved_path = os.path.join(destination, 'moved.mp4')
+        os.replace(original.filepath, moved_path)
+        def finish_move():
+            sleep(0.1)
+            original.filepath = moved_path
+        mover = Thread(target=finish_move)
+        mover.start()
+        assert detector.find_original(copy) is original
+        mover.join()
+
+    def test_only_size_collisions_are_read (self, monkeypatch):
+        clear_test_folder()
+        watch, destination = generate_files([])
+        recs = []
+        for i, contents in enumerate([b'a', b'bb', b'cc', b'bb']):
+            rec = LectureRecording(None, date(2023, 11, 14), time(14, 28), 4603, 'extron')
+            rec.filepath = os.path.join(watch, f'copy_{i}.mp4')
+            with open(rec.filepath, 'wb') as f:
+                f.write(contents)
+            recs.append(rec)
+
+        hashed = []
+        partial = dedup.partial_hash
+        monkeypatch.setattr(dedup, 'partial_hash', lambda path, size: hashed.append(path) or partial(path, size))
+        detector = DuplicateDetector()
+        assert [detector.find_original(rec) for rec in recs] == [None, None, None, recs[1]]
+        assert sorted(hashed) == sorted(rec.filepath for rec in recs[1:])
+
+        # The journal reuses the detector's fingerprint rather than reading the file again
+        journal = JobJournal(':memory:')
+        monkeypatch.setattr(job_journal, 'partial_hash', lambda path, size: pytest.fail('hashed twice'))
+        job = journal.open_job(recs[2], None, hash_contents=True)
+        assert job.content_hash == recs[2].partial_hash
+        journal.close()
+
+    def test_concurrent_duplicates_found_once (self):
+        clear_test_folder()
+        watch, destination = generate_files([])
+        recs = []
+        for i in range(8):
+            rec = LectureRecording(None, date(2023, 11, 14), time(14, 28), 4603, 'extron')
+            rec.filepath = os.path.join(watch, f'copy_{i}.mp4')
+            with open(rec.filepath, 'wb') as f:
+                f.write(b'same contents')
+            recs.append(rec)
+
+        detector = DuplicateDetector()
+        originals = []
+        threads = [Thread(target=lambda rec=rec: originals.append(detector.find_original(rec))) for rec in recs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert originals.count(None) == 1
+
     def test_no_videos (self):
         courses = read_test_courses()
         clear_test_folder()
@@ -247,6 +432,457 @@ class TestSorter:
         assert count_nondirectory_files(watch) == 0
         assert count_nondirectory_files(destination) == 0
 
+class TestMover:
+    def test_cross_device_copy_verified (self, monkeypatch):
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']], numBytes=1024)
+        [src] = [os.path.join(watch, f) for f in os.listdir(watch)]
+        mtime = os.path.getmtime(src)
+        monkeypatch.setattr(file_mover, 'is_same_device', lambda src, dest: False)
+        result = file_mover.move_file(src, os.path.join(destination, 'copied.mp4'), verify='hash')
+        assert result.copied and result.size == 1024
+        assert not os.path.exists(src)
+        assert os.path.getmtime(os.path.join(destination, 'copied.mp4')) == mtime
+
+        # A short copy leaves the original where it was
+        monkeypatch.setattr(file_mover, 'copy_file_contents', lambda src, dest: open(dest, 'wb').write(b'short'))
+        with pytest.raises(OSError):
+            file_mover.move_file(os.path.join(destination, 'copied.mp4'), os.path.join(watch, 'back.mp4'))
+        assert os.path.exists(os.path.join(destination, 'copied.mp4'))
+        assert os.listdir(watch) == []
+
+    def test_same_device_rename (self):
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']])
+        [src] = [os.path.join(watch, f) for f in os.listdir(watch)]
+        result = file_mover.move_file(src, os.path.join(destination, 'renamed.mp4'))
+        assert not result.copied
+        assert os.path.exists(os.path.join(destination, 'renamed.mp4'))
+
+class TestPipeline:
+    def test_backpressure (self):
+        pulled = []
+        finished = []
+        def source ():
+            for i in range(20):
+                pulled.append(i)
+                yield i
+
+        def slow (item):
+            # Everything pulled from the source but not finished is held in memory
+            assert len(pulled) - len(finished) <= 2 + 2 + 2 + 2
+            sleep(0.01)
+            finished.append(item)
+
+        def fails_on_odd (item):
+            if item % 2:
+                raise ValueError(item)
+            return item
+
+        first = Stage('double', lambda item: item * 2, workers=2)
+        pipeline = Pipeline(source(), [first, Stage('slow', slow, workers=2)], queue_size=2)
+        pipeline.run()
+        assert sorted(finished) == [i * 2 for i in range(20)]
+        assert pipeline.scanned == 20 and first.processed == 20
+        assert first.max_queue_depth <= 2
+
+        done = []
+        second = Stage('odd', fails_on_odd, on_done=lambda: done.append(second.processed))
+        Pipeline(range(10), [second, Stage('drop', lambda item: None)]).run()
+        assert second.failed == 5
+        assert done == [10]
+
+class TestMetrics:
+    def test_run_metrics_written (self):
+        courses = read_test_courses()
+        recs = get_test_recs()
+        clear_test_folder()
+        watch, destination = generate_files([recs['extron'], recs['capturecast'], recs['extron_invalid']], numBytes=10)
+        video_sorter.METRICS.reset()
+        video_sorter.METRICS.start_run()
+        process_existing_files(courses, watch, destination, 'Move', from_date=datetime(2023, 12, 1))
+
+        summary = video_sorter.METRICS.summary()
+        assert summary['matches'] == {'capturecast': {'hit': 1, 'miss': 0}, 'extron': {'hit': 1, 'miss': 1}}
+        assert summary['operations']['move_video']['count'] == 3
+        assert summary['operations']['reap_files']['errors'] == 0
+        assert summary['bytes']['moved'] == 30
+
+        prometheus_file = os.path.join(config.get('Paths', 'test_folder'), 'video_sorter.prom')
+        json_file = os.path.join(config.get('Paths', 'test_folder'), 'metrics.json')
+        video_sorter.write_run_metrics(prometheus_file, json_file)
+        with open(prometheus_file) as f:
+            text = f.read()
+        assert 'video_sorter_recordings_matched_total{device="extron",result="miss"} 1' in text
+        assert 'video_sorter_operation_duration_seconds_count{operation="move_video"} 3' in text
+        assert 'video_sorter_bytes_total{kind="moved"} 30' in text
+        assert '# TYPE video_sorter_bytes_total counter' in text
+        with open(json_file) as f:
+            assert json.load(f)['bytes']['moved'] == 30
+
+        # The next batch adds to the totals, and its duration leaves out the wait before it
+        sleep(0.5)
+        watch, destination = generate_files([recs['extron']], numBytes=10)
+        video_sorter.METRICS.start_run()
+        process_existing_files(courses, watch, destination, 'Move', from_date=datetime(2023, 12, 1))
+        video_sorter.write_run_metrics(prometheus_file, json_file)
+        with open(json_file) as f:
+            summary = json.load(f)
+        assert summary['bytes']['moved'] == 40
+        assert summary['runs'] == 2
+        assert summary['seconds'] < 0.5
+
+class TestWatcher:
+    def test_waits_for_stable_files (self):
+        courses = read_test_courses()
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']])
+        watcher = RecordingWatcher(watch, settle_seconds=0.2, use_events=False)
+        watcher.start()
+        assert not watcher.using_events
+        [path] = [os.path.join(watch, f) for f in os.listdir(watch)]
+        assert watcher.take_stable() == []
+        sleep(0.3)
+        with open(path, 'ab') as f:
+            f.write(b'more')
+        assert watcher.take_stable() == []
+        sleep(0.3)
+        assert watcher.take_stable() == [path]
+        assert watcher.poll() == 0
+
+        watcher.forget_handled()
+        assert watcher.poll() == 1
+
+        video_sorter.process_recordings(courses, [path], destination, 'Move')
+        assert count_nondirectory_files(os.path.join(destination, 'Fall23')) == 1
+
+    def test_events_throttled_to_check_interval (self):
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']])
+        watcher = RecordingWatcher(watch, settle_seconds=0, use_events=False, check_interval=0.3)
+        watcher.start()
+        watcher.take_stable()
+
+        # A burst of modify events doesn't wake the loop before the interval is up
+        start = monotonic()
+        watcher.notice(os.path.join(watch, 'capture.mp4'))
+        watcher.wait(5)
+        assert 0.25 <= monotonic() - start < 2
+
+@pytest.fixture
+def kaltura_standin (monkeypatch):
+    server = KalturaStandIn()
+    server.start()
+    monkeypatch.setattr(mock_kaltura_client, 'SERVICE_URL', server.service_url)
+    monkeypatch.setenv('PARTNER_ID', server.partner_id)
+    monkeypatch.setenv('TOKEN', 'token')
+    monkeypatch.setenv('TOKEN_ID', 'token_id')
+    yield server
+    server.stop()
+
+class TestUpload:
+    def test_concurrent_uploads (self, monkeypatch, caplog):
+        courses = read_test_courses()
+        first = get_test_recs()['extron']
+        second = LectureRecording(None, first.date, time(14, 31), 4603, 'extron')
+        clear_test_folder()
+        watch, destination = generate_files([first, second, get_test_recs()['extron_invalid']])
+
+        uploading = []
+        peak = []
+        lock = Lock()
+        def fake_upload_video (rec, course, client, name, index, chunk_size):
+            with lock:
+                uploading.append(name)
+                peak.append(len(uploading))
+            sleep(0.2)
+            assert os.path.exists(rec.filepath)
+            with lock:
+                uploading.remove(name)
+            return ('token', f'entry_{name}')
+
+        monkeypatch.setattr(video_sorter.KALTURA_SESSION, 'get_client', lambda: None)
+        monkeypatch.setattr(video_sorter, 'upload_video', fake_upload_video)
+        monkeypatch.setattr(video_sorter, 'UPLOAD_WORKERS', 2)
+        monkeypatch.setattr(video_sorter, 'LOG_UPLOAD_TIMINGS', True)
+        with caplog.at_level('INFO'):
+            process_existing_files(courses, watch, destination, 'Upload', from_date=datetime(2023, 4, 6))
+        assert max(peak) == 2
+        assert any(r.getMessage().startswith('Uploaded 2 recording(s)') for r in caplog.records)
+        assert count_nondirectory_files(watch) == 0
+        assert count_nondirectory_files(os.path.join(destination, 'Fall23')) == 2
+        assert count_nondirectory_files(os.path.join(destination, 'Unmatched_Videos')) == 1
+
+    def test_journal_skips_finished_upload (self, monkeypatch):
+        courses = read_test_courses()
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']])
+        journal = JobJournal(os.path.join(config.get('Paths', 'test_folder'), 'journal.sqlite3'))
+        uploads = []
+        def fake_upload_video (rec, course, client, name, index, chunk_size):
+            uploads.append(name)
+            return ('token_1', f'entry_{len(uploads)}')
+        monkeypatch.setattr(video_sorter.KALTURA_SESSION, 'get_client', lambda: None)
+        monkeypatch.setattr(video_sorter, 'upload_video', fake_upload_video)
+
+        # The process "dies" after uploading, before the move
+        monkeypatch.setattr(video_sorter, 'move_video', lambda rec, path, retention_index=None: False)
+        process_existing_files(courses, watch, destination, 'Upload', journal=journal)
+        assert count_nondirectory_files(watch) == 1
+        monkeypatch.undo()
+        monkeypatch.setattr(video_sorter.KALTURA_SESSION, 'get_client', lambda: None)
+        monkeypatch.setattr(video_sorter, 'upload_video', fake_upload_video)
+
+        process_existing_files(courses, watch, destination, 'Upload', journal=journal)
+        assert len(uploads) == 1
+        assert count_nondirectory_files(watch) == 0
+        [(job, transitions)] = journal.history('4603_20231114-1_20231114-142800_S1R1.mp4')
+        assert job.state == MOVED
+        assert job.entry_id_list == ['entry_1']
+        assert job.content_hash is not None
+        assert [t[0] for t in transitions] == [MATCHED, UPLOADING, UPLOADED, MOVE_FAILED, MOVED]
+        journal.close()
+
+    def test_chunked_upload_resumes (self, kaltura_standin):
+        # Without retries a failed chunk interrupts the upload
+        client = get_kaltura_client(KalturaConfiguration(retries=0))
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']], numBytes=35)
+        filepath = os.path.join(watch, os.listdir(watch)[0])
+
+        kaltura_standin.fail_calls['uploadtoken.upload'] = {2}
+        try:
+            upload_file_in_chunks(client, filepath, 10)
+            assert False, 'the third chunk should have failed'
+        except Exception:
+            pass
+        assert os.path.exists(get_upload_state_path(filepath))
+
+        token_id = upload_file_in_chunks(client, filepath, 10)
+        assert not os.path.exists(get_upload_state_path(filepath))
+        assert len(kaltura_standin.calls_to('uploadtoken.add')) == 1
+        assert [c['resumeAt'] for c in kaltura_standin.calls_to('uploadtoken.upload')] == ['0', '10', '20', '20', '30']
+        assert kaltura_standin.upload_tokens[token_id]['finished']
+        with open(filepath, 'rb') as f:
+            assert bytes(kaltura_standin.upload_tokens[token_id]['data']) == f.read()
+
+    def test_failed_chunk_retried (self, kaltura_standin):
+        client = get_kaltura_client(KalturaConfiguration(backoffFactor=0))
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']], numBytes=35)
+        filepath = os.path.join(watch, os.listdir(watch)[0])
+
+        # A 503 on the last chunk is retried from the server's offset within the same call
+        kaltura_standin.fail_calls['uploadtoken.upload'] = {3}
+        kaltura_standin.fail_status = 503
+
+        token_id = upload_file_in_chunks(client, filepath, 10)
+        assert client.retryCount == 1
+        assert len(kaltura_standin.calls_to('uploadtoken.get')) == 1
+        assert [c['resumeAt'] for c in kaltura_standin.calls_to('uploadtoken.upload')] == ['0', '10', '20', '30', '30']
+        with open(filepath, 'rb') as f:
+            assert bytes(kaltura_standin.upload_tokens[token_id]['data']) == f.read()
+
+    def test_failed_upload_resumes_next_pass (self, kaltura_standin, monkeypatch):
+        courses = read_test_courses()
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['extron']], numBytes=35)
+        filepath = os.path.join(watch, os.listdir(watch)[0])
+        monkeypatch.setattr(video_sorter, 'KALTURA_SESSION', KalturaSessionManager(KalturaConfiguration(retries=0, serviceUrl=kaltura_standin.service_url)))
+        monkeypatch.setattr(video_sorter, 'UPLOAD_CHUNK_SIZE', 10)
+
+        journal = JobJournal(':memory:')
+
+        # The third chunk fails, so the recording has to stay put with its upload state
+        kaltura_standin.fail_calls['uploadtoken.upload'] = {2}
+        process_existing_files(courses, watch, destination, 'Upload', from_date=datetime(2023, 12, 1), journal=journal)
+        assert os.path.exists(filepath)
+        assert os.path.exists(get_upload_state_path(filepath))
+        assert count_nondirectory_files(destination) == 0
+        [(job, _)] = journal.history(filepath)
+        assert job.state == UPLOAD_FAILED
+
+        # The next pass picks the same job back up
+        process_existing_files(courses, watch, destination, 'Upload', from_date=datetime(2023, 12, 1), journal=journal)
+        [(job, transitions)] = journal.history(filepath)
+        assert [t[0] for t in transitions] == [MATCHED, UPLOADING, UPLOAD_FAILED, UPLOADING, UPLOADED, MOVED]
+        journal.close()
+        assert count_nondirectory_files(watch) == 0
+        assert count_nondirectory_files(destination) == 1
+        assert len(kaltura_standin.calls_to('uploadtoken.add')) == 1
+        assert len(kaltura_standin.calls_to('media.add')) == 1
+        assert [c['resumeAt'] for c in kaltura_standin.calls_to('uploadtoken.upload')] == ['0', '10', '20', '20', '30']
+        [token] = kaltura_standin.upload_tokens.values()
+        assert token['finished'] and token['size'] == 35
+
+    def test_team_taught_course_uploaded_once (self, kaltura_standin):
+        client = get_kaltura_client()
+        course = read_test_courses()[2]
+        assert len(course.hosts) == 2
+        clear_test_folder()
+        watch, destination = generate_files([get_test_recs()['capturecast']])
+        rec = get_test_recs()['capturecast']
+        rec.filepath = os.path.join(watch, os.listdir(watch)[0])
+        video_sorter.upload_to_hosts(rec, course, client, os.path.join(destination, 'Course3.mp4'))
+        assert len(kaltura_standin.calls_to('uploadtoken.upload')) == 1
+        [entry] = kaltura_standin.media_entries.values()
+        owner = course.get_first_host_alphabetically().unid
+        [co_host] = [host.unid for host in course.hosts if host.unid != owner]
+        assert entry['userId'] == owner
+        assert entry['entitledUsersEdit'] == co_host and entry['entitledUsersPublish'] == co_host
+
+    def test_entry_created_in_one_multirequest (self, kaltura_standin):
+        client = get_kaltura_client(KalturaConfiguration(retries=0))
+        course = read_test_courses()[0]
+        clear_test_folder()
+        rec = get_test_recs()['extron']
+        watch, destination = generate_files([rec], numBytes=25)
+        requests_before = kaltura_standin.requests
+        token_id, entry_id = upload_video(rec, course, client, 'Course1', chunk_size=0)
+        assert kaltura_standin.requests - requests_before == 2
+        assert kaltura_standin.media_entries[entry_id]['uploadTokenId'] == token_id
+        assert kaltura_standin.upload_tokens[token_id]['finished']
+        assert not os.path.exists(get_upload_state_path(rec.filepath))
+
+        # A failed upload keeps the entry it already created, chunked or not
+        kaltura_standin.fail_calls['uploadtoken.upload'] = {1}
+        with pytest.raises(Exception):
+            upload_video(rec, course, client, 'Course1', chunk_size=0)
+        assert os.path.exists(get_upload_state_path(rec.filepath))
+        retried_token_id, retried_entry_id = upload_video(rec, course, client, 'Course1', chunk_size=0)
+        assert len(kaltura_standin.media_entries) == 2
+        assert kaltura_standin.upload_tokens[retried_token_id]['finished']
+
+        kaltura_standin.fail_calls['uploadtoken.upload'] = {5}
+        with pytest.raises(Exception):
+            upload_video(rec, course, client, 'Course1', chunk_size=10)
+        token_id, entry_id = upload_video(rec, course, client, 'Course1', chunk_size=10)
+        assert len(kaltura_standin.media_entries) == 3
+        assert len(kaltura_standin.calls_to('multirequest')) == 3
+        assert kaltura_standin.media_entries[entry_id]['uploadTokenId'] == token_id
+        with open(rec.filepath, 'rb') as f:
+            assert bytes(kaltura_standin.upload_tokens[token_id]['data']) == f.read()
+
+    def test_client_reuses_connections_and_retries (self, kaltura_standin):
+        client = get_kaltura_client(KalturaConfiguration(backoffFactor=0))
+        kaltura_standin.fail_status = 503
+        kaltura_standin.fail_calls['uploadtoken.add'] = {0}
+        kaltura_standin.fail_calls['uploadtoken.get'] = {0, 1}
+        # Adding a token isn't safe to repeat, so its 503 is raised
+        with pytest.raises(requests.HTTPError):
+            client.uploadToken.add(KalturaUploadToken())
+        token = client.uploadToken.add(KalturaUploadToken())
+        assert token.id in kaltura_standin.upload_tokens
+        client.uploadToken.get(token.id)
+        assert len(kaltura_standin.calls_to('uploadtoken.add')) == 2
+        assert len(kaltura_standin.calls_to('uploadtoken.get')) == 3
+        assert client.retryCount == 2
+        assert kaltura_standin.connections == 1
+
+    def test_session_reuse_and_renewal (self, kaltura_standin):
+        manager = KalturaSessionManager(expiry=3600, renew_before=600)
+        client = manager.get_client()
+        assert manager.get_client() is client
+        assert len(kaltura_standin.calls_to('apptoken.startSession')) == 1
+
+        kaltura_standin.expired_sessions.add(client.sessionData.ks)
+        client.uploadToken.add(KalturaUploadToken())
+        assert len(kaltura_standin.calls_to('apptoken.startSession')) == 2
+        assert len(kaltura_standin.calls_to('uploadtoken.add')) == 2
+
+        client.sessionData.expiry = datetime.now().timestamp() + 60
+        manager.get_client()
+        assert len(kaltura_standin.calls_to('apptoken.startSession')) == 3
+
+    def test_request_with_stale_session_after_renewal (self, kaltura_standin):
+        manager = KalturaSessionManager(expiry=3600, renew_before=600)
+        client = manager.get_client()
+        old_session = client.sessionData
+
+        # Another worker renews the session while this request is in flight with the old KS
+        client.sessionData.expiry = datetime.now().timestamp() + 60
+        manager.get_client()
+        kaltura_standin.expired_sessions.add(old_session.ks)
+        res = client.post(client.kurl('uploadtoken/action/add'), json=client.getRequestData(session=old_session))
+        assert res.json()['id'] in kaltura_standin.upload_tokens
+        # The newer session is reused rather than renewed again
+        assert len(kaltura_standin.calls_to('apptoken.startSession')) == 2
+        assert client.sessionData.ks != old_session.ks
+        assert client.sessionData.ks in [call['ks'] for call in kaltura_standin.calls_to('uploadtoken.add')]
+
+    def test_load_test_against_faulty_standin (self):
+        # Sessions expiring under several workers at once are renewed once each and nothing fails
+        report = load_test.run_load_test(files=40, sections=100, size=1024, workers=4, latency=0.002, expire_rate=0.05, backoff=0, seed=1)
+        assert report['injected_expiries'] > 0
+        assert report['uploaded'] == 40
+        assert report['upload_failures'] == 0
+        assert report['left_in_watch_folder'] == 0
+        assert report['sessions_started'] <= report['injected_expiries'] + 1
+        assert 0 < report['latency_p50'] <= report['latency_p95']
+
+        # Errors on calls that aren't safe to repeat fail those uploads, whose recordings stay for the next pass
+        report = load_test.run_load_test(files=40, sections=100, size=1024, workers=4, latency=0.002, error_rate=0.1, backoff=0, seed=1)
+        assert report['injected_errors'] > 0
+        assert report['upload_failures'] > 0
+        assert report['uploaded'] + report['upload_failures'] == 40
+        assert report['left_in_watch_folder'] == report['upload_failures']
+
+class TestFormatParser:
+    def test_filename_round_trip (self):
+        for name, expected in get_test_recs().items():
+            rec = parse_recording_filename(format_recording_filename(expected))
+            assert rec.rec_device == expected.rec_device
+            assert rec.date == expected.date
+            assert rec.time == expected.time
+            assert rec.course_number_full() == expected.course_number_full()
+
+    def test_unknown_filename (self):
+        assert parse_recording_filename('notes.mp4') is None
+        assert parse_recording_filename('4603_20231114-1_20231114-142800_S1R1.mov') is None
+
+class TestCourseIndex:
+    def make_course (self, number, room, days, start):
+        return Course(number, '1', number, 'LAST', room, days, start, [])
+
+    def test_tolerance_window (self):
+        course = self.make_course('LAW 1000', '4603', {'Tuesday'}, time(14, 30))
+        index = CourseIndex([course], timedelta(minutes=30))
+        tuesday = date(2023, 11, 14)
+        assert index.find_by_room_and_datetime(LectureRecording(None, tuesday, time(14, 0), '4603', 'extron')) is course
+        assert index.find_by_room_and_datetime(LectureRecording(None, tuesday, time(15, 0), '4603', 'extron')) is course
+        assert index.find_by_room_and_datetime(LectureRecording(None, tuesday, time(13, 59), '4603', 'extron')) is None
+        assert index.find_by_room_and_datetime(LectureRecording(None, tuesday, time(15, 1), '4603', 'extron')) is None
+        assert index.find_by_room_and_datetime(LectureRecording(None, tuesday, time(14, 30), '5200', 'extron')) is None
+        assert index.find_by_room_and_datetime(LectureRecording(None, date(2023, 11, 15), time(14, 30), '4603', 'extron')) is None
+
+    def test_overlapping_courses_prefer_first_listed (self):
+        later = self.make_course('LAW 2000', '4603', {'Monday'}, time(9, 0))
+        earlier = self.make_course('LAW 3000', '4603', {'Monday'}, time(8, 45))
+        index = CourseIndex([later, earlier], timedelta(minutes=30))
+        rec = LectureRecording(None, date(2023, 11, 13), time(8, 50), '4603', 'extron')
+        assert index.find_by_room_and_datetime(rec) is later
+
+    def test_number_and_section_collisions_keep_first (self):
+        first = Course('LAW 4560', '1', 'First', 'LAST', '5200', {'Tuesday'}, time(14, 30), [])
+        second = Course('LAW 4560', '1', 'Second', 'LAST', '5300', {'Tuesday'}, time(14, 30), [])
+        index = CourseIndex([first, second], timedelta(minutes=30))
+        rec = LectureRecording(None, date(2023, 11, 14), None, None, 'capturecast', '4560', '1', 'LAW')
+        assert index.find_by_number_and_section(rec) is first
+        rec.section_number = '2'
+        assert index.find_by_number_and_section(rec) is None
+
+    def test_list_lookups_see_edits (self):
+        tolerance = timedelta(minutes=30)
+        rec = LectureRecording(None, date(2023, 11, 14), time(14, 30), '4603', 'extron')
+        courses = [self.make_course('LAW 1', '5200', {'Tuesday'}, time(14, 30))]
+        index = get_course_index(courses, tolerance)
+        assert get_course_index(index, tolerance) is index
+        assert video_sorter.find_course_by_room_and_datetime(courses, rec) is None
+
+        # A list is indexed afresh each time, so an edit in place is never missed
+        courses[0] = self.make_course('LAW 2', '4603', {'Tuesday'}, time(14, 30))
+        assert video_sorter.find_course_by_room_and_datetime(courses, rec) is courses[0]
+
 def create_files_with_mod_date (dest_folder: str, pairs: list[tuple[str, datetime]]): 
     created = []
     for pair in pairs:
@@ -322,4 +958,106 @@ class TestReaper:
         assert count_nondirectory_files(dest) == 2
         assert not os.path.exists(folder_to_delete)
         assert os.path.exists(folder_to_keep)
-        assert count_nondirectory_files(folder_to_keep) == 1
\ No newline at end of file
+        assert count_nondirectory_files(folder_to_keep) == 1
+
+    def test_parallel_reap_dry_run(self):
+        dest = self.setup_directory()
+        folder_to_delete = os.path.join(dest, 'DELETE', 'NESTED')
+        folder_to_keep = os.path.join(dest, 'KEEP')
+        os.makedirs(folder_to_delete)
+        os.mkdir(folder_to_keep)
+        old = create_files_with_mod_date(folder_to_delete, [
+            ('shouldbedeleted', datetime(2020, 5, 6, 6, 45, 10)),
+        ]) + create_files_with_mod_date(folder_to_keep, [
+            ('shouldbedeleted', datetime(2020, 1, 4, 15, 59, 17)),
+        ])
+        create_files_with_mod_date(folder_to_keep, [
+            ('shouldbekept', datetime(2023, 8, 4, 15, 59, 17))
+        ])
+        stats = ReapStats()
+        planned = reap_files_parallel(dest, datetime(2023, 5, 22, 12, 00), workers=4, dry_run=True, stats=stats)
+        assert sorted(planned) == sorted(old + [folder_to_delete, os.path.dirname(folder_to_delete)])
+        assert count_nondirectory_files(dest) == 3
+        assert stats.dirs_scanned == 5 and stats.stat_calls == 3 and stats.files_deleted == 0
+
+        deleted = reap_files_parallel(dest, datetime(2023, 5, 22, 12, 00), workers=4)
+        assert sorted(deleted) == sorted(planned)
+        assert count_nondirectory_files(dest) == 1
+        assert not os.path.exists(os.path.dirname(folder_to_delete))
+        assert os.path.exists(folder_to_keep)
+
+    def test_reap_by_semester(self):
+        dest = self.setup_directory()
+        semesters = {name: os.path.join(dest, name, 'LAW 1230_Course1') for name in ['Fall22', 'Spring23', 'Summer23', 'Fall23']}
+        for folder in semesters.values():
+            os.makedirs(folder)
+        create_files_with_mod_date(semesters['Fall22'], [('new mtime, old semester', datetime(2023, 8, 1))])
+        boundary = create_files_with_mod_date(semesters['Spring23'], [
+            ('tooold', datetime(2023, 4, 21, 6, 34, 32)),
+            ('newenough', datetime(2023, 4, 30, 15, 43)),
+        ])
+        create_files_with_mod_date(semesters['Fall23'], [('newer', datetime(2023, 9, 1))])
+        stats = ReapStats()
+        deleted = reap_files_parallel(dest, datetime(2023, 4, 22), stats=stats)
+        assert deleted == [os.path.join(dest, 'Fall22'), boundary[0]]
+        assert stats.semesters_deleted == 1 and stats.semesters_skipped == 2
+        assert stats.dirs_scanned == 4
+        assert os.path.exists(boundary[1])
+        assert count_nondirectory_files(dest) == 2
+        assert get_semester_range('Fall23') == (datetime(2023, 8, 1), datetime(2024, 1, 1))
+        assert get_semester_range('Unmatched_Videos') is None
+
+    def test_retention_index(self):
+        dest = self.setup_directory()
+        folder_to_delete = os.path.join(dest, 'DELETE')
+        os.mkdir(folder_to_delete)
+        index = RetentionIndex(os.path.join(config.get('Paths', 'test_folder'), 'retention.sqlite3'))
+        indexed = create_files_with_mod_date(folder_to_delete, [
+            ('tooold', datetime(2023, 4, 21, 6, 34, 32)),
+        ]) + create_files_with_mod_date(dest, [
+            ('newenough', datetime(2023, 6, 1, 15, 43)),
+        ])
+        unindexed = create_files_with_mod_date(dest, [
+            ('notindexed', datetime(2020, 1, 4, 15, 59, 17)),
+        ])
+        index.reconcile(dest, datetime(2000, 1, 1))
+        assert len(index) == 3
+        index.remove(unindexed[0])
+        for path in indexed:
+            index.add(path)
+
+        deleted = reap_indexed_files(index, dest, datetime(2023, 5, 22, 12, 00))
+        assert deleted == [indexed[0], folder_to_delete]
+        assert os.path.exists(unindexed[0])
+        assert len(index) == 1
+
+        index.reconcile(dest, datetime(2023, 5, 22, 12, 00))
+        assert not os.path.exists(unindexed[0])
+        assert count_nondirectory_files(dest) == 1
+        index.close()
+
+    def test_retention_index_reap_skips_bad_entries(self, monkeypatch):
+        dest = self.setup_directory()
+        outside = os.path.join(config.get('Paths', 'test_folder'), 'outside')
+        os.makedirs(outside, exist_ok=True)
+        index = RetentionIndex(':memory:')
+        locked, old = create_files_with_mod_date(dest, [
+            ('locked', datetime(2023, 1, 1)),
+            ('old', datetime(2023, 1, 2)),
+        ])
+        [stray] = create_files_with_mod_date(outside, [('stray', datetime(2023, 1, 1))])
+        for path in (locked, old, stray):
+            index.add(path)
+
+        unlink = os.unlink
+        def failing_unlink(path):
+            if path == locked:
+                raise PermissionError(13, 'Permission denied', path)
+            unlink(path)
+        monkeypatch.setattr(os, 'unlink', failing_unlink)
+
+        # One undeletable file doesn't stop the rest, and nothing outside the destination is touched
+        assert index.reap(dest, datetime(2023, 5, 22)) == [old]
+        assert os.path.exists(locked) and os.path.exists(stray)
+        assert [path for path, _ in index.expired(datetime(2023, 5, 22))] == [locked]
+        index.close()
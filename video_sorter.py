@@ -1,157 +1,244 @@
 
 import os
 import re
-from time import sleep
+from time import sleep, perf_counter
 import logging
 import logging.handlers
-import shutil
+from io import BytesIO
+from itertools import chain
+from functools import lru_cache
+from contextlib import nullcontext
+from threading import Lock
+from collections.abc import Iterable, Iterator
 import pandas as pd
 from datetime import datetime, timedelta, date, time
 import configparser
 from kaltura_uploader import *
 from data_types import *
 from format_parser import *
-from collections.abc import Callable
-from file_reaper import reap_files
+from file_reaper import reap_files_parallel, reap_indexed_files, ReapStats, RetentionIndex
+from course_index import CourseIndex, get_course_index
+from job_journal import *
+from dedup import DuplicateDetector
+from folder_watcher import RecordingWatcher
+from pipeline import Pipeline, Stage
+from file_mover import move_file, MoveResult
+from run_metrics import RunMetrics
+from course_cache import WorkbookFingerprint, read_workbook, load_cached_courses, save_cached_courses
 
 # Reading paths from config.ini
 config = configparser.ConfigParser()
 config.read('config.ini')
 
 RECORDING_START_TOLERANCE = timedelta(minutes=config.getint('Settings', 'start_time_tolerance'))
+UPLOAD_WORKERS = config.getint('Upload', 'workers', fallback=1)
+REAP_WORKERS = config.getint('Settings', 'reap_workers', fallback=8)
+VERIFY_COPIES = config.get('Settings', 'verify_copies', fallback='size')
+PIPELINE_QUEUE_SIZE = config.getint('Pipeline', 'queue_size', fallback=8)
+PIPELINE_WORKERS = {stage: config.getint('Pipeline', f'{stage}_workers', fallback=1) for stage in ('parse', 'match', 'hash', 'move')}
+LOG_UPLOAD_TIMINGS = config.getboolean('Upload', 'log_timings', fallback=True)
+UPLOAD_CHUNK_SIZE = int(config.getfloat('Upload', 'chunk_size_mb', fallback=0) * 1024 * 1024)
+KALTURA_CONFIG = KalturaConfiguration(
+    poolSize=config.getint('Kaltura', 'pool_size', fallback=max(10, UPLOAD_WORKERS)),
+    connectTimeout=config.getfloat('Kaltura', 'connect_timeout', fallback=10),
+    readTimeout=config.getfloat('Kaltura', 'read_timeout', fallback=300),
+    retries=config.getint('Kaltura', 'retries', fallback=3),
+    backoffFactor=config.getfloat('Kaltura', 'backoff_factor', fallback=1),
+    serviceUrl=config.get('Kaltura', 'service_url', fallback=None),
+)
+KALTURA_SESSION = KalturaSessionManager(
+    KALTURA_CONFIG,
+    expiry=config.getint('Kaltura', 'session_expiry', fallback=14400),
+    renew_before=config.getint('Kaltura', 'renew_before', fallback=600),
+)
+# Timings and counts since the sorter started, written out by write_run_metrics()
+METRICS = RunMetrics()
    
+DAY_PATTERN_REGEX = r'M|TTh|T|W|F|Sa'
+DAY_PATTERNS = {
+    'M': ('Monday',),
+    'TTh': ('Tuesday', 'Thursday'),
+    'T': ('Tuesday',),
+    'W': ('Wednesday',),
+    'F': ('Friday',),
+    'Sa': ('Saturday',),
+}
+START_TIME_REGEX = r'(\b\d{1,2}:\d{2}(?:am|pm)\b|\b\d{1,2}(?:am|pm)\b)'
+INSTRUCTOR_REGEX = r'([^(),\d]+),\s*([^()\d]+)\s+\((\d{8})\);*\s*'
+
+def parse_start_time(start_time_str: str) -> time:
+    """
+    Converts a start time such as 2:30pm or 9am into a time object
+    """
+    start_time_str = start_time_str.replace('am', 'AM').replace('pm', 'PM')
+    return datetime.strptime(start_time_str, '%I:%M%p' if ':' in start_time_str else '%I%p').time()
+
 # Read course details from the Excel sheet into the global 'courses' list
-def read_courses(excel_path) -> list[Course]:
+def read_courses(excel_path, use_cache: bool=True) -> list[Course]:
     """
     Reads a list of courses from an excel file and parses them to Course objects. 
     For an example of how this excel file should look, see test_courses.xlsx
+
+    Unless use_cache is False, the parsed courses are cached next to the 
+    workbook and reused for as long as the workbook's contents don't change.
     """
-    courses: list[Course] = []
-    df = pd.read_excel(excel_path)
-    df = df.dropna(how='all')
-    for index, row in df.iterrows():
-        instructor = str(row['Instructor LAST']).replace(' & ', ' ') if pd.notna(row['Instructor LAST']) else ''
-        days_pattern = re.findall(r'M|TTh|T|W|F|Sa', str(row['Meeting Pattern']))
-        days = set()  # Define the days list here
-        for day_pattern in days_pattern:
-            if day_pattern == 'M':
-                days.add('Monday')
-            elif day_pattern == 'TTh':
-                days.add('Tuesday')
-                days.add('Thursday')
-            elif day_pattern == 'T':
-                days.add('Tuesday')
-            elif day_pattern == 'W':
-                days.add('Wednesday')
-            elif day_pattern == 'F':
-                days.add('Friday')
-            elif day_pattern == 'Sa':
-                days.add('Saturday')
+    data, fingerprint = read_workbook(excel_path)
+    return read_courses_from_bytes(excel_path, data, fingerprint, use_cache)
 
-        start_time = None
+def read_courses_from_bytes(excel_path, data: bytes, fingerprint: WorkbookFingerprint, use_cache: bool=True) -> list[Course]:
+    """
+    Parses courses from workbook bytes which have already been read from 
+    excel_path, going through the course cache unless use_cache is False
+    """
+    with METRICS.timed('read_courses'):
+        if use_cache:
+            courses = load_cached_courses(excel_path, fingerprint)
+            if courses is not None:
+                logging.info(f'Loaded {len(courses)} courses from the cache for {excel_path}')
+                return courses
+
+        df = pd.read_excel(BytesIO(data))
+        courses = parse_courses(df)
+        if use_cache:
+            save_cached_courses(excel_path, fingerprint, courses)
+        return courses
+
+def parse_courses(df: pd.DataFrame) -> list[Course]:
+    """
+    Parses the rows of a schedule spreadsheet into Course objects. The text
+    columns are parsed a whole column at a time, and the results are then 
+    zipped together into courses in a single pass over the rows.
+    """
+    df = df.dropna(how='all')
 
-        # Extract time pattern from the correct column (modify as needed)
-        time_pattern = str(row['Meeting Pattern'])
+    instructor_last = df['Instructor LAST'].astype(str).str.replace(' & ', ' ', regex=False).where(df['Instructor LAST'].notna(), '')
+    meeting_patterns = df['Meeting Pattern'].fillna('').astype(str)
+    day_patterns = meeting_patterns.str.findall(DAY_PATTERN_REGEX)
 
-        # Correctly parse start time
-        start_time_str = re.search(r'\b\d{1,2}:\d{2}(?:am|pm)\b|\b\d{1,2}(?:am|pm)\b', time_pattern, re.IGNORECASE)
-        if start_time_str:
-            start_time_str = start_time_str.group()
-            start_time_str = start_time_str.replace('am', 'AM').replace('pm', 'PM')
-            start_time = datetime.strptime(start_time_str, '%I:%M%p' if ':' in start_time_str else '%I%p').time()
-        else:
-            logging.info(f"Invalid start time found for course {row['Course']}. Skipping.")
+    # Schedules only use a handful of distinct start times, so each is parsed once
+    start_time_strs = meeting_patterns.str.extract(START_TIME_REGEX, flags=re.IGNORECASE, expand=False)
+    start_times = {s: parse_start_time(s) for s in start_time_strs.dropna().unique()}
 
-        instructors = []
-        instructorStrings = row['Instructor'].split('; ')
-        for s in instructorStrings:
-            instructorMatch = re.search(r'([^(),\d]+),\s*([^()\d]+)\s+\((\d{8})\);*\s*', s)
-            groups = instructorMatch.groups()
-            instructors.append(EventHost(groups[1], groups[0], groups[2]))
+    # Split multi-instructor cells into one row per instructor, then extract the fields
+    instructor_parts = df['Instructor'].str.split('; ').explode()
+    instructor_fields = instructor_parts.str.extract(INSTRUCTOR_REGEX)
+    hosts: dict[object, list[EventHost]] = {}
+    for row_index, last, first, unid in instructor_fields.itertuples():
+        if pd.isna(unid):
+            raise ValueError(f"Could not parse instructor '{df.at[row_index, 'Instructor']}' for course {df.at[row_index, 'Course']}")
+        hosts.setdefault(row_index, []).append(EventHost(first, last, unid))
 
+    courses: list[Course] = []
+    for row_index, number, section_number, name, room, instructor, patterns, start_time_str in zip(
+        df.index,
+        df['Course'].tolist(),
+        df['Section #'].tolist(),
+        df['Course Title'].tolist(),
+        df['Room (cleaned)'].tolist(),
+        instructor_last.tolist(),
+        day_patterns.tolist(),
+        start_time_strs.tolist(),
+    ):
+        days = set()
+        for day_pattern in patterns:
+            days.update(DAY_PATTERNS[day_pattern])
 
-        # Extract and store the section number
-        section_number = row['Section #'] if pd.notna(row['Section #']) else None
+        start_time = None
+        if pd.notna(start_time_str):
+            start_time = start_times[start_time_str]
+        else:
+            logging.info(f"Invalid start time found for course {number}. Skipping.")
 
         course = Course(
-            row['Course'],
-            str(section_number),
-            row['Course Title'],
+            number,
+            str(section_number if pd.notna(section_number) else None),
+            name,
             instructor,
-            str(row['Room (cleaned)']),
+            str(room),
             days,
             start_time,
-            instructors
+            hosts[row_index]
         )
 
         courses.append(course)
         
     return courses
 
-def find_course_by_number_and_section(courses: list[Course], rec: LectureRecording) -> Course:
+class CourseSchedule:
+    """
+    Holds the course index for a schedule workbook and reloads it when the 
+    workbook changes. The index is rebuilt off to the side and swapped in 
+    with a single assignment, so anything holding the old index keeps a 
+    consistent view until it asks for the schedule again.
+    """
+    def __init__(self, excel_path):
+        self.excel_path = excel_path
+        self.index: CourseIndex | None = None
+        self.fingerprint: WorkbookFingerprint | None = None
+
+    def refresh(self) -> bool:
+        """
+        Reloads the courses if the workbook changed since the last refresh.
+        Returns True if a new course index was swapped in.
+        """
+        stat = os.stat(self.excel_path)
+        if self.fingerprint is not None and stat.st_size == self.fingerprint.size and stat.st_mtime_ns == self.fingerprint.mtime_ns:
+            return False
+
+        start = perf_counter()
+        data, fingerprint = read_workbook(self.excel_path)
+        if fingerprint.same_contents(self.fingerprint):
+            # Touched but not edited, nothing to reparse
+            self.fingerprint = fingerprint
+            return False
+
+        try:
+            courses = read_courses_from_bytes(self.excel_path, data, fingerprint)
+            index = CourseIndex(courses, RECORDING_START_TOLERANCE)
+        except Exception as e:
+            if self.index is None:
+                raise
+            logging.error(f'Could not reload courses from {self.excel_path}, keeping the previous schedule: {e}')
+            return False
+
+        reloaded = self.index is not None
+        self.index = index
+        self.fingerprint = fingerprint
+        verb = 'Reloaded' if reloaded else 'Loaded'
+        logging.info(f'{verb} {len(index)} courses from {self.excel_path} in {perf_counter() - start:.2f}s')
+        return True
+
+def find_course_by_number_and_section(courses: list[Course] | CourseIndex, rec: LectureRecording) -> Course:
     """
     Finds the course in the list whose number and section matches the 
-    one in the given recording object
+    one in the given recording object. A list is indexed on every call, so
+    callers looking up many recordings should pass a CourseIndex.
     """
     logging.debug(f"Searching for {rec} by course number and section")
 
-    # Iterate through the courses list and look for a match
-    for course in courses:
-        if course.number == rec.course_number_full() and course.section_number == rec.section_number:
-            return course
-
-    # Return None if no match is found
-    return None
+    index = get_course_index(courses, RECORDING_START_TOLERANCE)
+    return index.find_by_number_and_section(rec)
 
 def parse_recording_file(filepath: str) -> LectureRecording:
     """
     Parses a recording filename and puts that information into a recording object
     """
-    parsers: list[Callable[[str], LectureRecording or None]] = (
-        extron_format_parser,
-        capturecast_format_parser,
-        extron_2100_format_parser
-    )
-
-    for parser in parsers:
-        rec = parser(filepath)
-        if rec is not None:
-            return rec
+    rec = parse_recording_filename(filepath)
+    if rec is not None:
+        return rec
     
     return LectureRecording(filepath, None, None, None, None)
 
-def find_course_by_room_and_datetime(courses: list[Course], rec: LectureRecording) -> Course:
+def find_course_by_room_and_datetime(courses: list[Course] | CourseIndex, rec: LectureRecording) -> Course:
     """
     Finds the course in the given list which has a matching room, 
-    date and time to the given recording
+    date and time to the given recording. A list is indexed on every call,
+    so callers looking up many recordings should pass a CourseIndex.
     """
     logging.debug(f'Trying to match {rec} by room and datetime')
 
-    # Iterate through the courses and look for a match
-    for course in courses:
-        # Check for room match
-        if course.room_number != rec.room_number:
-            continue
-            
-        if rec.time is None:
-            continue
-
-        weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        recording_weekday = rec.date.weekday()
-
-        if weekdays[recording_weekday] not in course.days:
-            continue
-
-        # Check if the file's datetime is within a tolerance window around the course start time
-        tolerance = RECORDING_START_TOLERANCE
-        course_datetime_no_date = datetime(2023, 1, 1, course.start_time.hour, course.start_time.minute)
-        rec_datetime_no_date = datetime(2023, 1, 1, rec.time.hour, rec.time.minute)
-        window_start = course_datetime_no_date - tolerance
-        window_end = course_datetime_no_date + tolerance
-        if window_start <= rec_datetime_no_date and rec_datetime_no_date <= window_end:
-            return course
-    
-    return None
+    index = get_course_index(courses, RECORDING_START_TOLERANCE)
+    return index.find_by_room_and_datetime(rec)
 
 def determine_semester(date: date):
     """
@@ -167,71 +254,112 @@ def determine_semester(date: date):
         return f'Fall{year}'
 
 
+@lru_cache(maxsize=4096)
 def get_folder_safe_name(name) -> str:
     def is_valid_char (char: str):
         return char.isalnum() or char == " " or char == "_" or char == "-"
     
     return "".join([x if is_valid_char(x) else "" for x in name])
 
-def get_or_create_class_folder(course: Course, rec: LectureRecording, dest_folder: str):
+def get_or_create_class_folder(course: Course, rec: LectureRecording, dest_folder: str, folder_cache: dict[tuple[str, str, str], str] | None=None):
     """
     Returns the file path of the folder where a recording should go 
-    based on the recording date and course
+    based on the recording date and course.
+
+    If a folder cache is given, folders already in it are returned without
+    touching the disk and new ones are added to it. A run passes the same 
+    cache for every recording, so each folder is created at most once.
     """
 
     semester = determine_semester(rec.date)
-    
-    # Create the semester folder if it doesn't exist
-    semester_path = os.path.join(dest_folder, semester)
-    os.makedirs(semester_path, exist_ok=True)
-    
-    # Create the course folder inside the semester folder
     folder_name = get_folder_safe_name(f"{course.number}_{course.name}_{course.instructor_last}")
-    folder_path = os.path.join(semester_path, folder_name)
-    folder_path = os.path.abspath(folder_path)  # Use absolute path
+    key = (dest_folder, semester, folder_name)
+    if folder_cache is not None and key in folder_cache:
+        return folder_cache[key]
+
+    # Create the course folder, and the semester folder above it, if they don't exist
+    folder_path = os.path.abspath(os.path.join(dest_folder, semester, folder_name))
     try:
-        os.makedirs(folder_path, exist_ok=True)
+        os.makedirs(folder_path)
         logging.info(f"Folder created at {folder_path}")
+    except FileExistsError:
+        pass
     except Exception as e:
         logging.error(f"An error occurred while creating directory: {e}")
+        return folder_path
 
+    if folder_cache is not None:
+        folder_cache[key] = folder_path
     return folder_path
 
-def get_new_filepath(rec: LectureRecording, course: Course, dest_folder: str):
+def get_free_filepath(folder: str, name: str, ext: str, reserved_paths: set[str] | None=None) -> str:
+    """
+    Returns folder/name + ext, or with _1, _2, ... appended to the name if 
+    that is already taken by a file or by a path in reserved_paths. The 
+    returned path is added to reserved_paths, if given.
+    """
+    counter = 1
+    full_path = os.path.join(folder, f'{name}{ext}')
+
+    def is_taken(path):
+        return os.path.exists(path) or (reserved_paths is not None and path in reserved_paths)
+
+    # If the file already exists, append a number to the name
+    while is_taken(full_path):
+        full_path = os.path.join(folder, f'{name}_{counter}{ext}')
+        counter += 1
+
+    if reserved_paths is not None:
+        reserved_paths.add(full_path)
+    return full_path
+
+def get_new_filepath(rec: LectureRecording, course: Course, dest_folder: str, reserved_paths: set[str] | None=None, folder_cache: dict[tuple[str, str, str], str] | None=None):
     """
     Returns a new filepath for the recording based on the course you assign it to by passing it in here.
 
     For example, LAW 5000_Beekhuizen_11-17-2023
+
+    If a set of reserved paths is given, paths in it are treated as taken 
+    and the returned path is added to it. This lets concurrent uploads claim
+    a name before their file has actually been moved there. The folder 
+    cache is passed on to get_or_create_class_folder.
     """
-    dest_folder = get_or_create_class_folder(course, rec, dest_folder)
+    dest_folder = get_or_create_class_folder(course, rec, dest_folder, folder_cache)
     
     # Convert the date to a more readable format
     readable_date = rec.date.strftime("%m-%d-%y")
 
     new_filename = get_folder_safe_name(f"{course.name}_{course.instructor_last}_{readable_date}")
-    counter = 1
-    ext = '.mp4'
-    full_path = os.path.join(dest_folder, f'{new_filename}{ext}')
-
-    # If the file already exists, append a number to the name
-    while os.path.exists(full_path):
-        full_path = os.path.join(dest_folder, f'{new_filename}_{counter}{ext}')
-        counter += 1
-
+    full_path = get_free_filepath(dest_folder, new_filename, '.mp4', reserved_paths)
     return full_path
 
-def move_video(rec: LectureRecording, dest_path):
+def move_recording_file(rec: LectureRecording, dest_path) -> MoveResult:
+    """
+    Moves a recording's file to dest_path, adding the time it took and 
+    the bytes moved to the run's metrics
+    """
+    with METRICS.timed('move_video'):
+        result = move_file(rec.filepath, dest_path, VERIFY_COPIES)
+    METRICS.add_bytes('moved', result.size)
+    return result
+
+def move_video(rec: LectureRecording, dest_path, retention_index: RetentionIndex | None=None):
     """
-    Moves a recording to the given destination
+    Moves a recording to the given destination, adding it to the 
+    retention index if there is one
     """
     try:
-        shutil.move(rec.filepath, dest_path)
-        logging.info(f"Video moved from {rec.filepath} to {dest_path}")
+        result = move_recording_file(rec, dest_path)
+        logging.info(f"Video moved from {rec.filepath} to {dest_path} ({result})")
         rec.filepath = dest_path
+        if retention_index is not None:
+            retention_index.add(dest_path)
+        return True
     except Exception as e:
         logging.error(f"An error occurred while moving {rec}: {e}")
+        return False
 
-def move_unmatched_video(rec: LectureRecording, dest_folder):
+def move_unmatched_video(rec: LectureRecording, dest_folder, retention_index: RetentionIndex | None=None):
     """
     Moves a recording to the unmatched videos location specified in the config
     """
@@ -239,111 +367,312 @@ def move_unmatched_video(rec: LectureRecording, dest_folder):
     os.makedirs(unmatched_folder, exist_ok=True)
     dest_path = os.path.join(unmatched_folder, os.path.basename(rec.filepath))
     try:
-        shutil.move(rec.filepath, dest_path)
-        logging.warning(f"No course matched for {rec}. Moved to {unmatched_folder}")
+        result = move_recording_file(rec, dest_path)
+        logging.warning(f"No course matched for {rec}. Moved to {unmatched_folder} ({result})")
         rec.filepath = dest_path
+        if retention_index is not None:
+            retention_index.add(dest_path)
+        return True
     except Exception as e:
         logging.error(f"An error occurred while moving file: {e}")
+        return False
 
-def match_courses_to_recordings (courses: list[Course], watch_path) -> list[tuple[LectureRecording, Course or None]]:
+def move_duplicate_video(rec: LectureRecording, original: LectureRecording, dest_folder, retention_index: RetentionIndex | None=None, reserved_paths: set[str] | None=None, path_lock=None):
     """
-    Looks for videos in the watch path and tries to figure out which 
-    course in the given list it was for. Returns a list of tuples
-    which associates each recording to a course (or null)
+    Moves a recording with the same contents as one already being processed
+    to the duplicates folder, instead of uploading or sorting it a second time.
+    The name is reserved in reserved_paths under path_lock, so concurrent 
+    moves in the same run don't pick the same one.
     """
-    pairs = []
-    for filename in os.listdir(watch_path):
+    duplicates_folder = os.path.join(dest_folder, 'Duplicates')
+    os.makedirs(duplicates_folder, exist_ok=True)
+    # A recording dropped three times has two duplicates with the same name
+    name, ext = os.path.splitext(os.path.basename(rec.filepath))
+    with path_lock or nullcontext():
+        dest_path = get_free_filepath(duplicates_folder, name, ext, reserved_paths)
+    try:
+        result = move_recording_file(rec, dest_path)
+        logging.warning(f"{rec.filename} is a duplicate of {original.filename}. Moved to {duplicates_folder} ({result})")
+        rec.filepath = dest_path
+        if retention_index is not None:
+            retention_index.add(dest_path)
+        return True
+    except Exception as e:
+        logging.error(f"An error occurred while moving duplicate file: {e}")
+        return False
 
-        if not filename.endswith('.mp4'):
-            continue
+def handle_duplicate (rec: LectureRecording, course: Course or None, detector: DuplicateDetector, dest_folder: str, journal: JobJournal | None=None, retention_index: RetentionIndex | None=None, reserved_paths: set[str] | None=None, path_lock=None) -> bool:
+    """
+    Moves the recording to the duplicates folder if the detector has seen 
+    its contents before. Returns whether it was a duplicate.
+    """
+    try:
+        original = detector.find_original(rec)
+    except Exception as e:
+        logging.error(f'Could not check {rec} for duplicates: {e}')
+        original = None
 
-        filepath = os.path.join(watch_path, filename)
-        rec = parse_recording_file(filepath)
+    if original is None:
+        return False
 
-        if rec.was_scheduled():
-            logging.info(rec)
-            
-            if rec.time is None:
-                course = find_course_by_number_and_section(courses, rec)
-            else:
-                course = find_course_by_room_and_datetime(courses, rec)
+    # Opened before the move, so the job keeps the recording's watch folder path
+    job = journal.open_job(rec, course) if journal is not None else None
+    moved = move_duplicate_video(rec, original, dest_folder, retention_index, reserved_paths, path_lock)
+    if journal is not None:
+        journal.transition(job, DUPLICATE if moved else MOVE_FAILED, f'duplicate of {original.filename}', dest_path=rec.filepath if moved else None)
+    return True
 
-            if course is not None:
-                pairs.append((rec, course))
-            else:
-                pairs.append((rec, None))
+def match_recording (index: CourseIndex, rec: LectureRecording) -> Course or None:
+    """
+    Tries to figure out which course in the index a parsed recording was for
+    """
+    if not rec.was_scheduled():
+        METRICS.count_match(rec.rec_device, False)
+        return None
+
+    logging.info(rec)
+    with METRICS.timed('match_recording'):
+        if rec.time is None:
+            course = find_course_by_number_and_section(index, rec)
         else:
-            pairs.append((rec, None))
+            course = find_course_by_room_and_datetime(index, rec)
+    METRICS.count_match(rec.rec_device, course is not None)
+    return course
 
-    return pairs
+def iter_matched_recordings (courses: list[Course] | CourseIndex, watch_path) -> Iterator[tuple[LectureRecording, Course or None]]:
+    """
+    Streams the videos in the watch path, yielding each recording with its 
+    matching course (or None) as soon as it has been parsed, so callers can
+    start moving or uploading before the whole folder has been read. The 
+    stat result from the directory scan is kept on the recording as file_stat.
+    """
+    index = get_course_index(courses, RECORDING_START_TOLERANCE)
+    for entry in iter_watch_folder(watch_path):
+        rec = parse_recording_file(entry.path)
+        rec.file_stat = entry.stat()
+        yield (rec, match_recording(index, rec))
 
-def move_files (pairs: list[tuple[LectureRecording, Course or None]], dest_folder: str):
+def iter_watch_folder (watch_path) -> Iterator[os.DirEntry]:
     """
-    Given a list of recordings and their matching course, generate the new 
-    file name and move the video to the correct folder.
+    Streams the directory entries of the videos in the watch path
     """
-    for pair in pairs:
-        if pair[1] is None:
-            move_unmatched_video(pair[0], dest_folder)
-        else:
-            new_path = get_new_filepath(pair[0], pair[1], dest_folder)
-            move_video(pair[0], new_path)
-            for ins in pair[1].hosts:
-                logging.debug(f'Video moved for {ins}')
+    with os.scandir(watch_path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.mp4') and entry.is_file():
+                yield entry
 
-def upload_files (pairs: list[tuple[LectureRecording, Course or None]], dest_folder: str):
+def match_courses_to_recordings (courses: list[Course] | CourseIndex, watch_path) -> list[tuple[LectureRecording, Course or None]]:
     """
-    Given a list of tuples containing Recordings and their corresponding Courses, 
-    uploads files to Kaltura, and then sorts them into folders based on their course
+    Looks for videos in the watch path and tries to figure out which 
+    course in the given list it was for. Returns a list of tuples
+    which associates each recording to a course (or null)
+    """
+    return list(iter_matched_recordings(courses, watch_path))
+
+def record_move (journal: JobJournal | None, job: Job | None, rec: LectureRecording, moved: bool):
+    """
+    Notes the outcome of moving a recording in the journal, if there is one
     """
+    if journal is not None:
+        journal.transition(job, MOVED if moved else MOVE_FAILED, dest_path=rec.filepath if moved else None)
+
+def upload_to_hosts (rec: LectureRecording, course: Course, client: KalturaClient, new_path: str, journal: JobJournal | None=None, job: Job | None=None) -> bool:
+    """
+    Uploads a recording to Kaltura once, named after the path it will be 
+    moved to. The entry belongs to the course's first host alphabetically 
+    and is shared with the other hosts. Skipped if the job shows an 
+    earlier, interrupted run already uploaded it. Returns whether the 
+    recording is on Kaltura, and so can be moved.
+    """
+    finished_uploads = job.entry_id_list if job else []
+    if finished_uploads:
+        logging.info(f'Skipping upload of {rec}, it was already uploaded as entry {finished_uploads[0]}. Now moving')
+        return True
+
     try:
-        client = get_kaltura_client()
+        new_name = os.path.basename(new_path).replace('.mp4', '')
+        size = rec.file_stat.st_size if rec.file_stat else os.path.getsize(rec.filepath)
+        if job:
+            journal.transition(job, UPLOADING, f'for {", ".join(host.unid for host in course.hosts)}')
+        start = perf_counter()
+        with METRICS.timed('upload_video'):
+            upload_token, entry_id = upload_video(rec, course, client, new_name, -1, UPLOAD_CHUNK_SIZE)
+        elapsed = perf_counter() - start
+        METRICS.add_bytes('uploaded', size)
+        if job:
+            journal.add_entry(job, upload_token, entry_id)
+        logging.info(f'Sucessfully uploaded: {rec} for {len(course.hosts)} host(s). Now moving')
+        if LOG_UPLOAD_TIMINGS:
+            logging.info(f'Uploaded {size / 1_000_000:.1f} MB in {elapsed:.1f}s ({size / 1_000_000 / max(elapsed, 1e-6):.2f} MB/s) for {rec.filename}')
+        return True
     except Exception as e:
-        logging.error(f"Could not establish a kaltura session: {e}")
-        return
-    for pair in pairs:
-        if pair[1] is not None:
-            for i, insr in enumerate(pair[1].hosts):
-                try:
-                    new_path = get_new_filepath(pair[0], pair[1], dest_folder)
-                    new_name = os.path.basename(new_path).replace('.mp4', '')
-                    upload_video(pair[0], pair[1], client, new_name, i)
-                    logging.info(f'Sucessfully uploaded: {pair[0]}. Now moving')
-                except Exception as e:
-                    logging.error(f'Error while uploading and moving {pair[0]}. {e}')
-
-                move_video(pair[0], new_path)
-                logging.info(f'Sucessfully moved: {pair[0]}')
-        else:
-            move_unmatched_video(pair[0], dest_folder)
+        logging.error(f'Error while uploading {rec}, leaving it in the watch folder to try again on the next pass. {e}')
+        if job:
+            journal.transition(job, UPLOAD_FAILED, str(e))
+        return False
 
-
-def process_existing_files(courses: list[Course], watch_path, dest_path, mode, weeks_before_deletion=26, from_date: date | None=None):
+def process_existing_files(courses: list[Course] | CourseIndex, watch_path, dest_path, mode, weeks_before_deletion=26, from_date: date | None=None, journal: JobJournal | None=None, deduplicate: bool=False, retention_index: RetentionIndex | None=None, reconcile_every: timedelta=timedelta(days=7)):
     """
     Given a list of courses and file path on which to watch for 
     videos, processes videos according to what mode has been set 
-    in the config file.
-    """
-    pairs = match_courses_to_recordings(courses, watch_path)
-    if len(pairs) > 0:
-        if mode == 'Upload':
-            upload_files(pairs, dest_path)
-        elif mode == 'Move':
-            move_files(pairs, dest_path)
-    else:
+    in the config file. If a job journal is given, every recording's
+    progress is recorded in it and interrupted work is resumed. With
+    deduplicate, recordings whose contents repeat an earlier one are 
+    moved to the duplicates folder instead. With a retention index, 
+    only the files it lists as expired are reaped, plus a full scan 
+    every reconcile_every.
+    """
+    process_recordings(courses, iter_watch_folder(watch_path), dest_path, mode, journal, deduplicate, retention_index)
+    reap_destination(dest_path, weeks_before_deletion, from_date, retention_index, reconcile_every)
+
+def build_pipeline(courses: list[Course] | CourseIndex, sources: Iterable[str | os.DirEntry], dest_path, mode, client: KalturaClient | None=None, journal: JobJournal | None=None, deduplicate: bool=False, retention_index: RetentionIndex | None=None, detector: DuplicateDetector | None=None) -> Pipeline:
+    """
+    Builds the scan -> parse -> match -> hash -> upload -> move pipeline
+    for the given video files (paths or scandir entries). The upload stage
+    is left out in Move mode. Worker counts and queue sizes come from the
+    [Pipeline] and [Upload] sections of the config.
+    """
+    index = get_course_index(courses, RECORDING_START_TOLERANCE)
+    detector = detector if detector is not None else DuplicateDetector()
+    reserved_paths: set[str] = set()
+    duplicate_paths: set[str] = set()
+    folder_cache: dict[tuple[str, str, str], str] = {}
+    path_lock = Lock()
+    # Recordings sent to Kaltura this run, for the total logged when the upload stage finishes
+    upload_totals = {'uploads': 0, 'bytes': 0, 'start': None}
+    upload_lock = Lock()
+
+    def parse_stage(source):
+        if isinstance(source, os.DirEntry):
+            rec = parse_recording_file(source.path)
+            rec.file_stat = source.stat()
+        else:
+            rec = parse_recording_file(source)
+            rec.file_stat = os.stat(source)
+        return rec
+
+    def match_stage(rec):
+        return (rec, match_recording(index, rec))
+
+    def hash_stage(pair):
+        rec, course = pair
+        if deduplicate and handle_duplicate(rec, course, detector, dest_path, journal, retention_index, duplicate_paths, path_lock):
+            return None
+        job = journal.open_job(rec, course, hash_contents=mode == 'Upload' and course is not None) if journal else None
+        new_path = None
+        if course is not None:
+            with path_lock:
+                new_path = get_new_filepath(rec, course, dest_path, reserved_paths, folder_cache)
+        return (rec, course, job, new_path)
+
+    def upload_stage(item):
+        rec, course, job, new_path = item
+        if course is None:
+            return item
+        with upload_lock:
+            if upload_totals['start'] is None:
+                upload_totals['start'] = perf_counter()
+        # An upload finished by an earlier run is skipped, so it isn't part of this run's total
+        already_uploaded = bool(job and job.entry_id_list)
+        # A recording that didn't make it to Kaltura stays in the watch folder for the next pass
+        if not upload_to_hosts(rec, course, client, new_path, journal, job):
+            return None
+        if not already_uploaded:
+            size = rec.file_stat.st_size if rec.file_stat else os.path.getsize(rec.filepath)
+            with upload_lock:
+                upload_totals['uploads'] += 1
+                upload_totals['bytes'] += size
+        return item
+
+    def log_upload_totals():
+        if not LOG_UPLOAD_TIMINGS or upload_totals['uploads'] == 0:
+            return
+        elapsed = perf_counter() - upload_totals['start']
+        megabytes = upload_totals['bytes'] / 1_000_000
+        logging.info(f"Uploaded {upload_totals['uploads']} recording(s), {megabytes:.1f} MB with {UPLOAD_WORKERS} worker(s) in {elapsed:.1f}s ({megabytes / max(elapsed, 1e-6):.2f} MB/s)")
+
+    def move_stage(item):
+        rec, course, job, new_path = item
+        if course is None:
+            record_move(journal, job, rec, move_unmatched_video(rec, dest_path, retention_index))
+        else:
+            record_move(journal, job, rec, move_video(rec, new_path, retention_index))
+        return None
+
+    stages = [
+        Stage('parse', parse_stage, PIPELINE_WORKERS['parse']),
+        Stage('match', match_stage, PIPELINE_WORKERS['match']),
+        Stage('hash', hash_stage, PIPELINE_WORKERS['hash']),
+    ]
+    if mode == 'Upload':
+        stages.append(Stage('upload', upload_stage, UPLOAD_WORKERS, log_upload_totals))
+    stages.append(Stage('move', move_stage, PIPELINE_WORKERS['move']))
+    return Pipeline(sources, stages, PIPELINE_QUEUE_SIZE)
+
+def process_recordings(courses: list[Course] | CourseIndex, sources: Iterable[str | os.DirEntry], dest_path, mode, journal: JobJournal | None=None, deduplicate: bool=False, retention_index: RetentionIndex | None=None, detector: DuplicateDetector | None=None):
+    """
+    Moves or uploads and moves the given video files, depending on the mode,
+    and logs how each stage of the pipeline did
+    """
+    sources = iter(sources)
+    first_source = next(sources, None)
+    if first_source is None:
         logging.info("No new videos to sort")
+        return
+    if mode not in ('Upload', 'Move'):
+        logging.error(f'Unknown mode {mode}, expected Upload or Move')
+        return
+
+    client = None
+    if mode == 'Upload':
+        try:
+            client = KALTURA_SESSION.get_client()
+        except Exception as e:
+            logging.error(f"Could not establish a kaltura session: {e}")
+            return
 
+    pipeline = build_pipeline(courses, chain([first_source], sources), dest_path, mode, client, journal, deduplicate, retention_index, detector)
+    pipeline.run()
+    pipeline.log_stats()
+
+def reap_destination(dest_path, weeks_before_deletion=26, from_date: date | None=None, retention_index: RetentionIndex | None=None, reconcile_every: timedelta=timedelta(days=7)):
+    """
+    Deletes the recordings in the destination older than the retention period
+    """
     start_date = from_date if from_date else datetime.now()
     cutoff = start_date - timedelta(weeks = weeks_before_deletion)
     logging.info(f'Reaping all files last modified before {cutoff.strftime("%m/%d/%Y, %H:%M:%S")}')
     try:
-        reaped_files = reap_files(dest_path, cutoff)
+        stats = ReapStats()
+        with METRICS.timed('reap_files'):
+            if retention_index is not None:
+                reaped_files = reap_indexed_files(retention_index, dest_path, cutoff, reconcile_every, REAP_WORKERS, stats)
+            else:
+                reaped_files = reap_files_parallel(dest_path, cutoff, REAP_WORKERS, stats=stats)
+        METRICS.count('files_reaped', len(reaped_files))
+        METRICS.add_bytes('reaped', stats.bytes_deleted)
         for f in reaped_files:
             logging.info(f'File deleted: {f}')
         logging.info(f'Deleted {len(reaped_files)} file(s)')
+        if stats.dirs_scanned:
+            logging.info(f'Reaper {stats}')
     except Exception as e:
         logging.error(f'Error occurred while reaping files: {e}')
 
+def write_run_metrics(prometheus_file: str | None=None, json_file: str | None=None):
+    """
+    Ends the run started by METRICS.start_run() and writes the metrics to
+    a Prometheus textfile and/or a JSON summary
+    """
+    METRICS.finish_run()
+    try:
+        if prometheus_file:
+            METRICS.write_prometheus(prometheus_file)
+        if json_file:
+            METRICS.write_json(json_file)
+    except Exception as e:
+        logging.error(f'Could not write the run metrics: {e}')
+
 if __name__ == "__main__":
     WATCH_FOLDER = os.path.normpath(config.get('Paths', 'watch_folder'))
     WATCH_FOLDER = os.path.abspath(WATCH_FOLDER)
@@ -352,6 +681,16 @@ if __name__ == "__main__":
     MODE = os.path.normpath(config.get('Settings', 'mode'))
     LOG_FILE = config.get('Settings', 'log_file')
     WEEKS_BEFORE_DELETION = config.getint('Settings', 'weeks_before_deletion')
+    JOURNAL_FILE = config.get('Settings', 'journal_file', fallback='journal.sqlite3')
+    DEDUPLICATE = config.getboolean('Settings', 'deduplicate', fallback=True)
+    RETENTION_INDEX_FILE = config.get('Settings', 'retention_index_file', fallback='retention.sqlite3')
+    RECONCILE_EVERY = timedelta(days=config.getint('Settings', 'reconcile_days', fallback=7))
+    WATCH_MODE = config.get('Settings', 'watch_mode', fallback='nightly')
+    NIGHTLY_HOUR = config.getint('Settings', 'nightly_hour', fallback=3)
+    SETTLE_SECONDS = config.getint('Settings', 'settle_seconds', fallback=60)
+    POLL_INTERVAL = config.getint('Settings', 'poll_interval', fallback=15)
+    METRICS_PROMETHEUS_FILE = config.get('Metrics', 'prometheus_file', fallback=None)
+    METRICS_JSON_FILE = config.get('Metrics', 'json_file', fallback=None)
 
     print(f'See {LOG_FILE} for logs')
     
@@ -373,14 +712,59 @@ if __name__ == "__main__":
     smtp_handler.setLevel(smtp_level)
     logging.getLogger().addHandler(smtp_handler)
 
-    courses = read_courses(EXCEL_FILE_PATH)
+    journal = JobJournal(JOURNAL_FILE)
+    retention_index = RetentionIndex(RETENTION_INDEX_FILE)
+    schedule = CourseSchedule(EXCEL_FILE_PATH)
+    schedule.refresh()
     has_processed_videos = False
-    
+
+    if WATCH_MODE == 'events':
+        # Sort each recording once it has finished being written, and reap once a night
+        watcher = RecordingWatcher(WATCH_FOLDER, SETTLE_SECONDS, check_interval=POLL_INTERVAL)
+        watcher.start()
+        detector = DuplicateDetector()
+        last_reaped = None
+        while True:
+            # One bad pass (e.g. the watch share dropping out) mustn't stop the watcher
+            try:
+                watcher.wait(POLL_INTERVAL)
+                if not watcher.using_events:
+                    watcher.poll()
+                ready = watcher.take_stable()
+                reap = last_reaped is None or (datetime.now().hour == NIGHTLY_HOUR and last_reaped != date.today())
+                if ready or reap:
+                    METRICS.start_run()
+                if ready:
+                    logging.info(f'{len(ready)} new recording(s) ready to sort')
+                    try:
+                        schedule.refresh()
+                    except Exception as e:
+                        logging.error(f'Could not check {EXCEL_FILE_PATH} for changes: {e}')
+                    process_recordings(schedule.index, ready, DEST_FOLDER, MODE, journal, DEDUPLICATE, retention_index, detector)
+                if reap:
+                    # Marked first, so a reap that fails is tried again tomorrow rather than every pass
+                    last_reaped = date.today()
+                    reap_destination(DEST_FOLDER, WEEKS_BEFORE_DELETION, retention_index=retention_index, reconcile_every=RECONCILE_EVERY)
+                    # Retry anything that couldn't be moved, and stop comparing against yesterday's recordings
+                    watcher.forget_handled()
+                    watcher.poll()
+                    detector = DuplicateDetector()
+                if ready or reap:
+                    write_run_metrics(METRICS_PROMETHEUS_FILE, METRICS_JSON_FILE)
+            except Exception as e:
+                logging.error(f'Unexpected error while watching {WATCH_FOLDER}, carrying on: {e}')
+
     while True:
         current_time = datetime.now().time()
-        if current_time.hour == 3 or not has_processed_videos:
-            logging.info("It's around 3 AM, time to sort the videos.")
-            process_existing_files(courses, WATCH_FOLDER, DEST_FOLDER, MODE, WEEKS_BEFORE_DELETION)
+        if current_time.hour == NIGHTLY_HOUR or not has_processed_videos:
+            logging.info("It's time to sort the videos.")
+            METRICS.start_run()
+            try:
+                schedule.refresh()
+            except Exception as e:
+                logging.error(f'Could not check {EXCEL_FILE_PATH} for changes: {e}')
+            process_existing_files(schedule.index, WATCH_FOLDER, DEST_FOLDER, MODE, WEEKS_BEFORE_DELETION, journal=journal, deduplicate=DEDUPLICATE, retention_index=retention_index, reconcile_every=RECONCILE_EVERY)
+            write_run_metrics(METRICS_PROMETHEUS_FILE, METRICS_JSON_FILE)
             has_processed_videos = True
             sleep(3600)  # Sleep for 1 hour
         else: